@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CPython/NumPy implementation of find_basal_edges from myosin_and_morphology.py, for
+reprocessing saved myosin masks outside ImageJ. Each frame's edge is found for all columns
+at once within search_range of the previous frame's edge, and gaps are filled with the
+same rules as the Jython code, giving a (frames x width) int array. track_basal_edges is a
+globally optimised alternative. Edges are stored in the compact int16 format written by
+myosin_and_morphology.save_basal_edges, which load_edges memory-maps.
+"""
+
+import argparse
+import glob
+import json
+import os
+import struct
+
+import numpy as np
+from skimage import io
+
+EDGES_SUFFIX = '_basal_edges.i16'
+EDGES_MAGIC = b'BASALEDG'
+
+def save_edges(path, edges, metadata=None):
+	# 8 byte magic, little-endian uint32 header length, JSON header (metadata, shape, dtype)
+	# space-padded so the data starts on a 16 byte boundary, then (frames, width)
+	# little-endian int16 - as myosin_and_morphology.save_basal_edges
+	edges = np.asarray(edges)
+	header = dict(metadata or {})
+	header.update({'shape': list(edges.shape), 'dtype': '<i2', 'y_origin': 'top row = 0'})
+	text = json.dumps(header)
+	text += ' ' * (-(len(EDGES_MAGIC) + 4 + len(text)) % 16)
+	with open(path, 'wb') as f:
+		f.write(EDGES_MAGIC)
+		f.write(struct.pack('<I', len(text)))
+		f.write(text.encode('ascii'))
+		f.write(edges.astype('<i2').tobytes())
+
+def read_edges_header(path):
+	# header dictionary and byte offset of the data
+	with open(path, 'rb') as f:
+		if f.read(len(EDGES_MAGIC)) != EDGES_MAGIC:
+			raise IOError(path + " is not a basal edges file")
+		header_length = struct.unpack('<I', f.read(4))[0]
+		header = json.loads(f.read(header_length).decode('ascii'))
+	return header, len(EDGES_MAGIC) + 4 + header_length
+
+def load_edges(path, mmap=True):
+	# (frames, width) int16 edges and the header (calibration etc.). With mmap the array is
+	# a read-only memory map, so single frames of long series can be read without loading
+	# the whole file
+	header, offset = read_edges_header(path)
+	shape = tuple(header['shape'])
+	if mmap:
+		return np.memmap(path, dtype=header['dtype'], mode='r', offset=offset, shape=shape), header
+	with open(path, 'rb') as f:
+		f.seek(offset)
+		edges = np.frombuffer(f.read(), dtype=header['dtype'])
+	return edges.reshape(shape), header
+
+def round_half_away(v):
+	# python 2 round(), as used by the Jython code - halves go away from zero
+	return np.sign(v) * np.floor(np.abs(v) + 0.5)
+
+def first_frame_edge(frame):
+	# lowest non-zero pixel in each column (-1 for an empty column, where the Jython
+	# version would not terminate)
+	nonzero = frame != 0
+	from_bottom = np.argmax(nonzero[::-1], axis=0)
+	return np.where(nonzero.any(axis=0), frame.shape[0] - 1 - from_bottom, -1)
+
+def windowed_edge(frame, last_edge, search_range=10):
+	# lowest non-zero pixel in each column between last_edge - search_range and
+	# last_edge + search_range inclusive; pixels outside the image count as 0 and columns
+	# with no edge in the window are -1
+	height, width = frame.shape
+	offsets = np.arange(2 * search_range + 1)
+	ys = (np.asarray(last_edge, dtype=int) + search_range)[None, :] - offsets[:, None]
+	inside = (ys >= 0) & (ys < height)
+	values = np.where(inside, frame[np.clip(ys, 0, height - 1), np.arange(width)[None, :]], 0) != 0
+	found = values.any(axis=0)
+	return np.where(found, ys[np.argmax(values, axis=0), np.arange(width)], -1)
+
+def fill_edge_gaps(edge, last_edge):
+	# vectorised fill_edge_gaps from myosin_and_morphology.py: a missing first position
+	# takes the previous frame's value; runs of -1 with a good position after them (before
+	# the last column) are interpolated between their neighbours; a run reaching the last
+	# or second-to-last column continues the last good position to the end of the row,
+	# overwriting the last column
+	edge = np.array(edge, dtype=float)
+	width = len(edge)
+	if edge[0] == -1:
+		edge[0] = last_edge[0]
+	idx = np.arange(width)
+	good = edge != -1
+	good[0] = True
+	x1 = np.maximum.accumulate(np.where(good, idx, 0))
+	x2 = np.minimum.accumulate(np.where(good, idx, width)[::-1])[::-1]
+	gap = ~good
+	trailing = gap & (x2 >= width - 1)
+	interior = gap & ~trailing
+	if interior.any():
+		xa, xb, x = x1[interior], x2[interior], idx[interior]
+		# same arithmetic as the Jython code rather than np.interp, whose slope-first form
+		# can round differently at exact halves
+		edge[interior] = round_half_away((x - xa).astype(float) / (xb - xa) * (edge[xb] - edge[xa]) + edge[xa])
+	if trailing.any():
+		start = x1[np.argmax(trailing)]
+		edge[start:] = edge[start]
+	return edge.astype(int)
+
+def find_basal_edges(mask, search_range=10):
+	# (frames, height, width) mask, non-zero = myosin -> (frames, width) edge array. The
+	# first frame is assumed to be good, as in the Jython code
+	mask = np.asarray(mask)
+	if mask.ndim == 2:
+		mask = mask[None]
+	edges = np.empty((mask.shape[0], mask.shape[2]), dtype=int)
+	edges[0] = first_frame_edge(mask[0])
+	for fridx in range(1, mask.shape[0]):
+		edge = windowed_edge(mask[fridx], edges[fridx - 1], search_range=search_range)
+		edges[fridx] = fill_edge_gaps(edge, edges[fridx - 1])
+	return edges
+
+def edge_costs(mask, band=5):
+	# cost of placing the edge at each (frame, x, y) of a (frames, height, width) mask: the
+	# fraction of pixels disagreeing with "myosin in the band pixels down to y, background
+	# in the band pixels below y", from cumulative sums along y. Returned as
+	# (frames, width, height) float32
+	fg = np.moveaxis(np.asarray(mask) != 0, 1, 2)
+	height = fg.shape[2]
+	counts = np.zeros(fg.shape[:2] + (height + 1,), dtype=np.int32)
+	np.cumsum(fg, axis=2, out=counts[:, :, 1:])
+	y = np.arange(height)
+	above_start = np.clip(y - band + 1, 0, height)
+	below_stop = np.clip(y + band + 1, 0, height)
+	fg_above = counts[:, :, y + 1] - counts[:, :, above_start]
+	bg_above = (y + 1 - above_start) - fg_above
+	fg_below = counts[:, :, below_stop] - counts[:, :, y + 1]
+	return ((bg_above + fg_below) / float(band)).astype(np.float32)
+
+def viterbi_rows(unary, smoothness, max_step):
+	# minimum of sum(unary[f, x, y[x]]) + smoothness * sum(|y[x] - y[x-1]|), with
+	# |y[x] - y[x-1]| <= max_step, for every frame f of a (frames, width, height) unary at
+	# once. Returns (frames, width) int positions
+	n_frames, width, height = unary.shape
+	steps = np.arange(-max_step, max_step + 1)
+	back = np.empty((n_frames, width, height), dtype=np.int8)
+	acc = unary[:, 0, :].astype(np.float64)
+	padded = np.full((n_frames, height + 2 * max_step), np.inf)
+	for x in range(1, width):
+		padded[:, max_step:max_step + height] = acc
+		# candidates[k][f, y] - cost arriving at y from y + steps[k] in the previous column
+		candidates = np.stack([padded[:, max_step + d:max_step + d + height] + smoothness * abs(d)
+							   for d in steps])
+		k = np.argmin(candidates, axis=0)
+		back[:, x, :] = k
+		acc = np.take_along_axis(candidates, k[None], axis=0)[0] + unary[:, x, :]
+	path = np.empty((n_frames, width), dtype=int)
+	path[:, -1] = np.argmin(acc, axis=1)
+	frames = np.arange(n_frames)
+	for x in range(width - 1, 0, -1):
+		path[:, x - 1] = path[:, x] + steps[back[frames, x, path[:, x]]]
+	return path
+
+def edge_energy(costs, edges, smoothness_x, smoothness_t):
+	frames, width = np.indices(edges.shape)
+	return (costs[frames, width, edges].sum() + 
+			smoothness_x * np.abs(np.diff(edges, axis=1)).sum() + 
+			smoothness_t * np.abs(np.diff(edges, axis=0)).sum())
+
+def track_basal_edges(mask, smoothness_x=0.5, smoothness_t=0.5, max_step=3, band=5, n_sweeps=10):
+	# optional alternative to find_basal_edges: chooses the edge surface y(t, x) minimising
+	# edge_costs plus L1 smoothness penalties across x and t over the whole stack, rather
+	# than searching greedily frame by frame, so a single bad frame doesn't propagate.
+	# Frames are solved exactly along x by batched Viterbi given their neighbouring frames,
+	# alternating even and odd frames (block coordinate descent, so the energy never
+	# increases) - each sweep is linear in the stack size. Returns a (frames, width) int
+	# array like find_basal_edges; .tolist() gives the Jython edges layout
+	mask = np.asarray(mask)
+	if mask.ndim == 2:
+		mask = mask[None]
+	costs = edge_costs(mask, band=band)
+	n_frames, width, height = costs.shape
+	edges = viterbi_rows(costs, smoothness_x, max_step)
+	if n_frames == 1 or smoothness_t == 0:
+		return edges
+	y = np.arange(height)
+	energy = edge_energy(costs, edges, smoothness_x, smoothness_t)
+	for _ in range(n_sweeps):
+		for parity in (0, 1):
+			f = np.arange(parity, n_frames, 2)
+			unary = costs[f].astype(np.float64)
+			for neighbour in (f - 1, f + 1):
+				ok = (neighbour >= 0) & (neighbour < n_frames)
+				unary[ok] += smoothness_t * np.abs(y[None, None, :] - edges[neighbour[ok], :, None])
+			edges[f] = viterbi_rows(unary, smoothness_x, max_step)
+		new_energy = edge_energy(costs, edges, smoothness_x, smoothness_t)
+		if new_energy >= energy:
+			break
+		energy = new_energy
+	return edges
+
+def process_mask_file(mask_path, search_range=10, track=False):
+	if track:
+		edges = track_basal_edges(io.imread(mask_path))
+	else:
+		edges = find_basal_edges(io.imread(mask_path), search_range=search_range)
+	edges_path = os.path.splitext(mask_path)[0] + EDGES_SUFFIX
+	save_edges(edges_path, edges, {'source': os.path.basename(mask_path),
+								   'method': 'track_basal_edges' if track else 'find_basal_edges'})
+	return edges_path
+
+def main():
+	parser = argparse.ArgumentParser(description="Find basal edges in saved binary myosin mask stacks")
+	parser.add_argument('masks', nargs='+', help="mask tif files, or folders to search for them")
+	parser.add_argument('-p', '--pattern', default='*mask*.tif',
+						help="file pattern used when a folder is given")
+	parser.add_argument('-s', '--search-range', type=int, default=10)
+	parser.add_argument('-g', '--global-tracking', action='store_true',
+						help="optimise the edges over the whole stack (track_basal_edges)")
+	args = parser.parse_args()
+	paths = []
+	for m in args.masks:
+		if os.path.isdir(m):
+			paths.extend(sorted(glob.glob(os.path.join(m, '**', args.pattern), recursive=True)))
+		else:
+			paths.append(m)
+	for path in paths:
+		print("Wrote " + process_mask_file(path, search_range=args.search_range, track=args.global_tracking))
+
+if __name__ == '__main__':
+	main()
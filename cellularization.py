@@ -11,7 +11,15 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
+import importlib.util
 import scipy.optimize as opt
+import scipy.stats as stats
+
+PARAMETER_NAMES = ('a', 'b', 'tau')
+RESULTS_FILENAME = 'cellularization_results.csv'
+VELOCITY_STORE_FILENAME = 'time_velocity_expo.parquet'
+# fewest front points worth resampling - one more than the exponential's parameters
+MIN_RESAMPLE_POINTS = 4
 
 def fitted_func(t, a, b, tau):
 	return (a - b * np.exp(-t / tau))
@@ -19,167 +27,529 @@ def fitted_func(t, a, b, tau):
 def derivative_fitted_func(t, b, tau):
 	return ( (b / tau) * np.exp(-t/ tau))
 
-Folder = '20150601_01_sqhGFP'
-
-path = '/Users/cib/Documents/CF formation imaging/Exp27/E3TL/' + Folder
-tif_filename = path + '/cellu_front_y_t.tif'
-txt_filename = path + '/time_pixel_scales.txt'
-DF_txt = pd.read_csv(txt_filename, sep=' ')
-type(DF_txt)
-t_step_size = '%.1f'%(DF_txt.iloc[0,0])
-pixel_size = '%.3f'%(DF_txt.iloc[0,1])
-
-tif = io.imread(tif_filename)
-type(tif)
-
-[rows, cols] = np.shape(tif)
-# plt.figure()
-# plt.imshow(tif[:,:], cmap="gray")
-        
-DF = pd.DataFrame(tif)
-print(DF.columns)
-Y = len(DF)
-X = len(DF.columns)
-cdn = []
-
-""" Same as below
-for i, y in enumerate(np.arange(0, Y, 1)):
-   for j, x in enumerate(np.arange(0, X, 1)):
-       if DF.iloc[i, j] == 255:
-           edge = (i, j)
-           cdn.append(edge)
-DF_edge = pd.DataFrame(cdn)       
-"""   
-
-for y in np.arange(0, Y, 1):
-    for x in np.arange(0, X, 1):
-        if DF.iloc[y, x] == 255:
-            edge = (y, x)
-            cdn.append(edge)
-            break;
-DF_edge = pd.DataFrame(cdn)    
-
-DF_edge = DF_edge.rename(columns = {0:'time', 1: 'position'})
-DF_edge['position'] = DF_edge['position'] - DF_edge['position'].min(axis = 0)
-pos_max = DF_edge['position'].max(axis = 0)
-time_pos_max = DF_edge[DF_edge['position'] == pos_max]
-time_end = time_pos_max['time'].max(axis = 0)
-DF_edge_max = DF_edge[DF_edge['time'] <= time_end]
-
-plt.figure()
-plt.subplot(321)
-ax1 = plt.plot(DF_edge['time'],DF_edge['position'], 'x')
-ax2 = plt.plot(DF_edge_max['time'],DF_edge_max['position'], '.')
-plt.title("No fit")
-
-plt.subplot(322)
-z = np.polyfit(DF_edge_max['time'], DF_edge_max['position'], 1)
-#print(z)
-p = np.poly1d(z)
-#print(p(10))
-xp = np.linspace(0, time_end, 1000)
-ax = plt.plot(DF_edge_max['time'],DF_edge_max['position'], '.', xp, p(xp), '-')
-plt.title("Linear fit")
-
-plt.subplot(323)
-z = np.polyfit(DF_edge_max['time'], DF_edge_max['position'], 2)
-#print(z)
-p = np.poly1d(z)
-#print(p(10))
-xp = np.linspace(0, time_end, 1000)
-ax = plt.plot(DF_edge_max['time'],DF_edge_max['position'], '.', xp, p(xp), '-')
-plt.title("Second-order polynomial fit")
-
-plt.subplot(324)
-z = np.polyfit(DF_edge_max['time'], DF_edge_max['position'], 3)
-#print(z)
-p = np.poly1d(z)
-#print(p(10))
-xp = np.linspace(0, time_end, 1000)
-ax = plt.plot(DF_edge_max['time'],DF_edge_max['position'], '.', xp, p(xp), '-')
-plt.title("Third-order polynomial fit")
-
-plt.subplot(325)
-z = np.polyfit(DF_edge_max['time'], DF_edge_max['position'], 4)
-#print(z)
-p = np.poly1d(z)
-#print(p(10))
-xp = np.linspace(0, time_end, 1000)
-ax = plt.plot(DF_edge_max['time'],DF_edge_max['position'], '.', xp, p(xp), '-')
-plt.title("Fourth-order polynomial fit")
-
-plt.subplot(326)
-opt_parameters, pcov = opt.curve_fit(fitted_func, 
-                                     DF_edge_max['time'].astype('float'), 
-                                     DF_edge_max['position'].astype('float'))
-tp = np.linspace(0, time_end, 1000)
-ax = plt.plot(DF_edge_max['time'],DF_edge_max['position'], '.', 
-              tp, fitted_func(tp, *opt_parameters), '-')
-plt.title("Exponential fit")
-
-plt.tight_layout()
-
-print(opt_parameters)
-print("tau = %.3f" % opt_parameters[2])
-
-DF_edge_max['time_scaled'] = DF_edge_max['time'] * float(t_step_size) 
-DF_edge_max['position_scaled'] = DF_edge_max['position'] * float(pixel_size) 
-time_end_scaled = time_end * float(t_step_size) 
-
-#plt.figure()
-#plt.subplot(121)
-#z = np.polyfit(DF_edge_max['time_scaled'], DF_edge_max['position_scaled'], 3)
-#print(z)
-#p = np.poly1d(z)
-#xp = np.linspace(0, time_end_scaled, 1000)
-#ax = plt.plot(DF_edge_max['time_scaled'],DF_edge_max['position_scaled'], '.', xp, p(xp), '-')
-#
-#plt.subplot(122)
-#p2 = np.polyder(p)
-#print(p2)
-#xpxp = np.linspace(0, time_end_scaled, 1000)
-#ax = plt.plot(xpxp, p2(xpxp), '-')
-#Derivative = p2(xpxp)
-#print(Derivative)
-#
-#
-#DF_edge_max['velocity'] = p2(DF_edge_max['time_scaled'])
-#DF_v_t = pd.DataFrame({'timeframe': np.arange(1, time_end + 1 , 1),
-#                      'actual_time': np.arange(float(t_step_size), time_end_scaled + float(t_step_size), float(t_step_size)),
-#                      'velocity': p2(np.arange(float(t_step_size), time_end_scaled + float(t_step_size), float(t_step_size)))})
-#
-#os.chdir(path) 
-#DF_v_t.to_excel('time_velocity.xlsx')   
-
-plt.figure()
-plt.subplot(121)
-real_opt_parameters, pcov = opt.curve_fit(fitted_func, 
-                                          DF_edge_max['time_scaled'], 
-                                          DF_edge_max['position_scaled'])
-tp = np.linspace(0, time_end_scaled, 1000);
-ax = plt.plot(DF_edge_max['time_scaled'],DF_edge_max['position_scaled'], '.',
-              tp, fitted_func(tp, *real_opt_parameters), '-')
-
-plt.subplot(122)
-ax = plt.plot(tp, derivative_fitted_func(tp, real_opt_parameters[1], 
-                                         real_opt_parameters[2]), '-')
-
-DF_edge_max.loc[:,'velocity'] = derivative_fitted_func(DF_edge_max['time_scaled'], 
-                                                 real_opt_parameters[1], 
-                                                 real_opt_parameters[2])
-
-DF_v_t = pd.DataFrame({'timeframe': np.arange(1, time_end + 1 , 1),
-                      'actual_time': np.arange(float(t_step_size), time_end_scaled + float(t_step_size), float(t_step_size)),
-                      'velocity': derivative_fitted_func(np.arange(float(t_step_size), 
-                                                                   time_end_scaled + float(t_step_size), 
-                                                                   float(t_step_size)), 
-                                                         real_opt_parameters[1], real_opt_parameters[2])})
-
-
-DF_v_t.to_excel(os.path.join(path, 'time_velocity_expo.xlsx'))
-plt.show()
-
-
-
-
-
+def extract_front(tif, front_value=255):
+	# first column equal to front_value in every row of the segmented kymograph, found
+	# in one pass over the whole array. Rows with no front pixel (e.g. frames after the
+	# end of the analysis that were cleared in ImageJ) are dropped, as the original
+	# row-by-row search did.
+	is_front = (np.asarray(tif) == front_value)
+	has_front = is_front.any(axis=1)
+	return pd.DataFrame({'time': np.flatnonzero(has_front),
+						 'position': is_front[has_front].argmax(axis=1)})
+
+def load_embryo(path):
+	# segmented kymograph and time/pixel scales written by cellularization_1C.ijm
+	DF_txt = pd.read_csv(os.path.join(path, 'time_pixel_scales.txt'), sep=' ')
+	t_step_size = float('%.1f'%(DF_txt.iloc[0,0]))
+	pixel_size = float('%.3f'%(DF_txt.iloc[0,1]))
+	tif = io.imread(os.path.join(path, 'cellu_front_y_t.tif'))
+	return tif, t_step_size, pixel_size
+
+def trim_front(DF_edge):
+	# shift front so that it starts at zero, and keep only the part of the trajectory up
+	# to the last time the front is at its deepest position
+	if len(DF_edge) == 0:
+		raise ValueError("no front pixels in the segmented kymograph")
+	DF_edge['position'] = DF_edge['position'] - DF_edge['position'].min(axis = 0)
+	pos_max = DF_edge['position'].max(axis = 0)
+	time_pos_max = DF_edge[DF_edge['position'] == pos_max]
+	time_end = time_pos_max['time'].max(axis = 0)
+	DF_edge_max = DF_edge[DF_edge['time'] <= time_end].copy()
+	return DF_edge, DF_edge_max, time_end
+
+def velocity_table(time_end, t_step_size, real_opt_parameters):
+	actual_time = np.arange(t_step_size, time_end * t_step_size + t_step_size, t_step_size)
+	return pd.DataFrame({'timeframe': np.arange(1, time_end + 1 , 1),
+						 'actual_time': actual_time,
+						 'velocity': derivative_fitted_func(actual_time, 
+															real_opt_parameters[1], 
+															real_opt_parameters[2])})
+
+def velocity_table_key(path, root=None):
+	# the folder column of a velocity store: the analysis folder's path relative to the
+	# batch root, '/'-separated, so that folders with the same name in different
+	# experiments stay apart. Without a root (a store for a single folder) the folder name
+	if root is None:
+		return os.path.basename(os.path.normpath(path))
+	return os.path.relpath(os.path.normpath(path), os.path.normpath(root)).replace(os.sep, '/')
+
+def embryo_velocity_table(fit, root=None):
+	# velocity table for one fitted embryo, keyed by folder (see velocity_table_key) and
+	# carrying the exponential fit parameters so that a whole experiment can be held in
+	# one table
+	DF_v_t = velocity_table(fit['time_end'], fit['t_step_size'], fit['real_opt_parameters'])
+	DF_v_t.insert(0, 'folder', velocity_table_key(fit['path'], root))
+	for name, value in zip(PARAMETER_NAMES, fit['real_opt_parameters']):
+		DF_v_t[name] = value
+	DF_v_t['t_step_size'] = fit['t_step_size']
+	DF_v_t['pixel_size'] = fit['pixel_size']
+	return DF_v_t
+
+def velocity_store_path(store_path):
+	# Parquet needs pyarrow or fastparquet and Feather needs pyarrow; fall back to CSV with
+	# the same base name if the library for the requested format isn't installed
+	base, ext = os.path.splitext(store_path)
+	has_pyarrow = importlib.util.find_spec('pyarrow') is not None
+	if ext == '.parquet' and (has_pyarrow or importlib.util.find_spec('fastparquet') is not None):
+		return store_path
+	if ext == '.feather' and has_pyarrow:
+		return store_path
+	return base + '.csv'
+
+def read_velocity_store(store_path):
+	store_path = velocity_store_path(store_path)
+	ext = os.path.splitext(store_path)[1]
+	if ext == '.parquet':
+		return pd.read_parquet(store_path)
+	if ext == '.feather':
+		return pd.read_feather(store_path)
+	return pd.read_csv(store_path)
+
+def append_velocity_tables(store_path, tables):
+	# add embryo velocity tables to a columnar store, replacing any rows already stored
+	# for the same folders. Returns the path actually written (see velocity_store_path)
+	store_path = velocity_store_path(store_path)
+	DF_store = pd.concat(tables, ignore_index=True)
+	if os.path.isfile(store_path):
+		DF_old = read_velocity_store(store_path)
+		DF_old = DF_old[~DF_old['folder'].isin(DF_store['folder'].unique())]
+		DF_store = pd.concat([DF_old, DF_store], ignore_index=True)
+	ext = os.path.splitext(store_path)[1]
+	if ext == '.parquet':
+		DF_store.to_parquet(store_path, index=False)
+	elif ext == '.feather':
+		DF_store.to_feather(store_path)
+	else:
+		DF_store.to_csv(store_path, index=False)
+	return store_path
+
+def stack_trajectories(fronts):
+	# pad a list of front tables (e.g. DF_edge_max) into (n_trajectories, n_points) time
+	# and position arrays, with a mask marking which entries hold real data
+	n_points = max([len(f) for f in fronts] + [1])
+	time = np.zeros((len(fronts), n_points))
+	position = np.zeros((len(fronts), n_points))
+	mask = np.zeros((len(fronts), n_points), dtype=bool)
+	for i, f in enumerate(fronts):
+		time[i, :len(f)] = f['time']
+		position[i, :len(f)] = f['position']
+		mask[i, :len(f)] = True
+	return time, position, mask
+
+def fit_polynomials(time, position, degrees=(1, 2, 3, 4), mask=None):
+	# least-squares polynomial fits of every degree from a single QR factorisation of the
+	# highest-degree Vandermonde basis. Columns are in increasing powers, so the leading
+	# (deg+1) columns of Q and block of R are the factorisation of the degree-deg basis.
+	# time/position may be 1d (one trajectory) or 2d (one trajectory per row, fitted in
+	# one batched factorisation). Coefficients are returned highest power first, as from
+	# np.polyfit; trajectories with too few points for a given degree give NaN.
+	time = np.asarray(time, dtype=float)
+	position = np.asarray(position, dtype=float)
+	single = (time.ndim == 1)
+	time, position = np.atleast_2d(time), np.atleast_2d(position)
+	mask = np.ones(time.shape, dtype=bool) if mask is None else np.atleast_2d(mask)
+	max_deg = max(degrees)
+
+	# scale time to [-1, 1] per trajectory for conditioning, as np.polyfit scales columns
+	scale = np.abs(np.where(mask, time, 0)).max(axis=1)
+	scale[scale == 0] = 1
+	powers = np.arange(max_deg + 1)
+	vander = ((time / scale[:, None])[:, :, None] ** powers) * mask[:, :, None]
+	q, r = np.linalg.qr(vander)
+	qty = np.einsum('ntk,nt->nk', q, np.where(mask, position, 0))
+	n_valid = mask.sum(axis=1)
+
+	coefficients = {}
+	for deg in degrees:
+		r_deg = r[:, :deg + 1, :deg + 1].copy()
+		ok = (n_valid > deg) & (np.abs(np.diagonal(r_deg, axis1=1, axis2=2)).min(axis=1) > 0)
+		r_deg[~ok] = np.eye(deg + 1)
+		c = np.linalg.solve(r_deg, qty[:, :deg + 1, None])[:, :, 0] / scale[:, None] ** powers[:deg + 1]
+		c[~ok] = np.nan
+		coefficients[deg] = c[0, ::-1] if single else c[:, ::-1]
+	return coefficients
+
+def exponential_jacobian(t, a, b, tau):
+	# closed-form partial derivatives of fitted_func with respect to (a, b, tau);
+	# d/dtau is -(t/tau) times the front velocity, derivative_fitted_func
+	ex = np.exp(-t / tau)
+	return np.stack(np.broadcast_arrays(np.ones_like(ex), -ex, 
+										-(t / tau) * derivative_fitted_func(t, b, tau)), axis=-1)
+
+def exponential_initial_guess(time, position, mask):
+	# three-point estimate of tau from the mean position over three equal time windows:
+	# for a - b*exp(-t/tau) the differences between successive window means shrink by
+	# exp(-h/tau), h being the window length. a and b then follow from linear least
+	# squares with tau held fixed. time/position/mask are (n_trajectories, n_points);
+	# trajectories without points start from t = 0 and come out as NaN
+	has_points = mask.any(axis=1)
+	t_min = np.where(has_points, np.where(mask, time, np.inf).min(axis=1), 0.0)
+	t_max = np.where(has_points, np.where(mask, time, -np.inf).max(axis=1), 0.0)
+	span = np.where(np.isfinite(t_max - t_min) & (t_max > t_min), t_max - t_min, 1.0)
+	window = np.clip(((time - t_min[:, None]) * 3 / span[:, None]).astype(int), 0, 2)
+	means = []
+	for k in range(3):
+		in_window = mask & (window == k)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			means.append(np.where(in_window, position, 0).sum(axis=1) / in_window.sum(axis=1))
+	with np.errstate(invalid='ignore', divide='ignore'):
+		ratio = (means[2] - means[1]) / (means[1] - means[0])
+		tau = np.where((ratio > 0) & (ratio < 1), -(span / 3) / np.log(ratio), 
+					   np.where(ratio >= 1, 10 * span, span / 10))
+	# a front that is still close to linear gives a ratio near 1 and an unbounded tau;
+	# start such fits at the edge of the flat valley instead
+	tau = np.where(np.isfinite(tau), np.minimum(tau, 10 * span), span)
+
+	# linear least squares for position = a - b*ex
+	ex = np.where(mask, np.exp(-time / tau[:, None]), 0)
+	n = mask.sum(axis=1)
+	s_e, s_ee = ex.sum(axis=1), (ex * ex).sum(axis=1)
+	s_y, s_ey = np.where(mask, position, 0).sum(axis=1), (ex * position).sum(axis=1)
+	det = n * s_ee - s_e * s_e
+	with np.errstate(invalid='ignore', divide='ignore'):
+		a = np.where(det != 0, (s_ee * s_y - s_e * s_ey) / det, s_y / n)
+		b = np.where(det != 0, (s_e * s_y - n * s_ey) / det, 0.0)
+	return np.stack([a, b, tau], axis=-1)
+
+def fit_exponential(time, position, mask=None, p0=None, max_iter=200, ftol=1.49012e-8, xtol=1.49012e-8, 
+					max_tau_span=100.0):
+	# Levenberg-Marquardt fit of a - b*exp(-t/tau) to each trajectory (row), run for all
+	# trajectories at once, starting from exponential_initial_guess and using the
+	# analytic Jacobian. Returns parameters, covariance (scaled by the residual variance,
+	# as opt.curve_fit), whether each fit converged and the number of iterations taken.
+	# Only fits meeting the ftol/xtol criteria with tau at most max_tau_span times the
+	# trajectory's time span count as converged - a fit that stalls (no step reduces the
+	# cost) or drifts along the flat valley of a near-linear front to an ever larger tau
+	# is not. Trajectories with too few points or that don't converge give NaN parameters
+	# and covariance
+	time = np.asarray(time, dtype=float)
+	position = np.asarray(position, dtype=float)
+	single = (time.ndim == 1)
+	time, position = np.atleast_2d(time), np.atleast_2d(position)
+	mask = np.ones(time.shape, dtype=bool) if mask is None else np.atleast_2d(mask)
+	n_trajectories = time.shape[0]
+	n_valid = mask.sum(axis=1)
+
+	def residuals(idx, p):
+		r = position[idx] - fitted_func(time[idx], p[:, 0:1], p[:, 1:2], p[:, 2:3])
+		return np.where(mask[idx], r, 0)
+
+	def normal_equations(idx, p, r):
+		J = exponential_jacobian(time[idx], p[:, 0:1], p[:, 1:2], p[:, 2:3]) * mask[idx, :, None]
+		return np.einsum('ntk,ntl->nkl', J, J), np.einsum('ntk,nt->nk', J, r)
+
+	p = exponential_initial_guess(time, position, mask) if p0 is None else np.array(np.broadcast_to(p0, (n_trajectories, 3)), dtype=float)
+	everything = np.arange(n_trajectories)
+	with np.errstate(over='ignore', invalid='ignore'):
+		r = residuals(everything, p)
+	cost = (r * r).sum(axis=1)
+	damping = np.full(n_trajectories, 1e-3)
+	iterations = np.zeros(n_trajectories, dtype=int)
+	converged = np.zeros(n_trajectories, dtype=bool)
+	active = (n_valid > 3) & np.all(np.isfinite(p), axis=1) & np.isfinite(cost)
+
+	for _ in range(max_iter):
+		if not active.any():
+			break
+		idx = np.flatnonzero(active)
+		with np.errstate(over='ignore', invalid='ignore'):
+			JtJ, Jtr = normal_equations(idx, p[idx], r[idx])
+			diag = np.diagonal(JtJ, axis1=1, axis2=2)
+			diag = np.maximum(diag, 1e-12 * diag.max(axis=1, keepdims=True) + 1e-300)
+			step = np.linalg.solve(JtJ + damping[idx, None, None] * diag[:, :, None] * np.eye(3), 
+								   Jtr[:, :, None])[:, :, 0]
+			p_new = p[idx] + step
+			r_new = residuals(idx, p_new)
+			cost_new = (r_new * r_new).sum(axis=1)
+		iterations[idx] += 1
+
+		improved = np.isfinite(cost_new) & (cost_new <= cost[idx]) & (p_new[:, 2] > 0)
+		# as MINPACK, both the actual and the linearised (predicted) reduction in cost
+		# must be small, so that a long step across a flat valley isn't taken as converged
+		predicted = 2 * np.einsum('nk,nk->n', step, Jtr) - np.einsum('nk,nkl,nl->n', step, JtJ, step)
+		small_cost_change = (((cost[idx] - cost_new) <= ftol * cost[idx]) & 
+							 (np.abs(predicted) <= ftol * cost[idx]))
+		small_step = np.linalg.norm(step, axis=1) <= xtol * (np.linalg.norm(p[idx], axis=1) + xtol)
+		done = improved & (small_cost_change | small_step)
+		upd = idx[improved]
+		p[upd], r[upd], cost[upd] = p_new[improved], r_new[improved], cost_new[improved]
+		damping[idx] = np.where(improved, damping[idx] / 10, damping[idx] * 10)
+		# once damping is this large no step reduces the cost any further; the fit has
+		# stalled, which isn't taken as convergence
+		stalled = ~improved & (damping[idx] > 1e12)
+		converged[idx[done]] = True
+		active[idx[done | stalled]] = False
+
+	# a near-linear front only bounds tau from below, so reject fits that have run off to
+	# a tau far beyond anything the data can resolve
+	t_min = np.where(mask, time, np.inf).min(axis=1)
+	t_max = np.where(mask, time, -np.inf).max(axis=1)
+	with np.errstate(invalid='ignore'):
+		converged &= (p[:, 2] > 0) & (p[:, 2] <= max_tau_span * (t_max - t_min))
+
+	# covariance at the solution, as opt.curve_fit
+	opt_parameters = np.where(converged[:, None], p, np.nan)
+	pcov = np.full((n_trajectories, 3, 3), np.nan)
+	ok = np.flatnonzero(converged)
+	if len(ok):
+		JtJ, _ = normal_equations(ok, p[ok], r[ok])
+		dof = np.maximum(n_valid[ok] - 3, 1)
+		pcov[ok] = np.linalg.pinv(JtJ) * (cost[ok] / dof)[:, None, None]
+	if single:
+		return opt_parameters[0], pcov[0], converged[0], iterations[0]
+	return opt_parameters, pcov, converged, iterations
+
+def scale_exponential(opt_parameters, pcov, t_step_size, pixel_size):
+	# convert pixel/frame-unit exponential parameters to physical units. Since
+	# position_scaled = pixel_size * position and time_scaled = t_step_size * time, the fit
+	# in scaled units is the same fit with a, b multiplied by pixel_size and tau by
+	# t_step_size; the covariance transforms with the same (diagonal) Jacobian
+	d = np.stack(np.broadcast_arrays(pixel_size, pixel_size, t_step_size), axis=-1).astype(float)
+	real_opt_parameters = np.asarray(opt_parameters) * d
+	real_pcov = np.asarray(pcov) * d[..., :, None] * d[..., None, :]
+	return real_opt_parameters, real_pcov
+
+def resample_exponential(time, position, n_replicates=1000, method='bootstrap', 
+						 percentiles=(2.5, 50, 97.5), opt_parameters=None, seed=None):
+	# confidence intervals for (a, b, tau) of one trajectory. Every bootstrap (resampled
+	# with replacement) or jackknife (leave-one-out) replicate is refitted in a single
+	# batched fit_exponential call, warm started from the point estimate if given.
+	# Returns a (len(percentiles), 3) array in the units of time/position and the number
+	# of replicates whose fit converged. Jackknife percentiles are from the normal
+	# approximation with the jackknife standard error. Trajectories with fewer than
+	# MIN_RESAMPLE_POINTS points aren't resampled and give NaN with 0 replicates
+	time = np.asarray(time, dtype=float)
+	position = np.asarray(position, dtype=float)
+	n = len(time)
+	if n < MIN_RESAMPLE_POINTS:
+		return np.full((len(percentiles), 3), np.nan), 0
+	if method == 'bootstrap':
+		idx = np.random.default_rng(seed).integers(0, n, size=(n_replicates, n))
+	elif method == 'jackknife':
+		keep = np.arange(n - 1)[None, :]
+		idx = keep + (keep >= np.arange(n)[:, None])
+	else:
+		raise ValueError("Unknown resampling method " + str(method))
+	p0 = None
+	if opt_parameters is not None and np.all(np.isfinite(opt_parameters)):
+		p0 = opt_parameters
+	replicates, _, converged, _ = fit_exponential(time[idx], position[idx], p0=p0)
+	replicates = replicates[converged]
+	if len(replicates) == 0:
+		return np.full((len(percentiles), 3), np.nan), 0
+	if method == 'bootstrap':
+		return np.percentile(replicates, percentiles, axis=0), len(replicates)
+	centre = replicates.mean(axis=0) if p0 is None else p0
+	se = np.sqrt((n - 1.0) / n * ((replicates - replicates.mean(axis=0)) ** 2).sum(axis=0))
+	z = stats.norm.ppf(np.asarray(percentiles, dtype=float) / 100)
+	return centre + z[:, None] * se, len(replicates)
+
+def add_confidence_intervals(embryo, n_replicates=1000, method='bootstrap', 
+							 percentiles=(2.5, 50, 97.5), seed=None):
+	# resample DF_edge_max of a fitted embryo and store parameter percentiles in physical
+	# units, keyed by (parameter name, percentile). Embryos whose point fit didn't converge
+	# aren't resampled and get NaN with 0 replicates
+	DF_edge_max = embryo['DF_edge_max']
+	if embryo.get('converged', True):
+		values, n_converged = resample_exponential(DF_edge_max['time'], DF_edge_max['position'], 
+												   n_replicates=n_replicates, method=method, 
+												   percentiles=percentiles, 
+												   opt_parameters=embryo['opt_parameters'], seed=seed)
+	else:
+		values, n_converged = np.full((len(percentiles), 3), np.nan), 0
+	values = values * np.array([embryo['pixel_size'], embryo['pixel_size'], embryo['t_step_size']])
+	embryo['confidence_intervals'] = dict(((name, q), values[i, j]) 
+										  for i, q in enumerate(percentiles) 
+										  for j, name in enumerate(('a', 'b', 'tau')))
+	embryo['ci_method'] = method
+	embryo['ci_replicates'] = n_converged
+	return embryo
+
+def fit_trajectories(time, position, mask=None, poly_degrees=(1, 2, 3, 4)):
+	# all models for one trajectory or a stack of trajectories
+	poly_coefficients = fit_polynomials(time, position, degrees=poly_degrees, mask=mask)
+	opt_parameters, pcov, converged, iterations = fit_exponential(time, position, mask=mask)
+	return {'poly_coefficients': poly_coefficients,
+			'opt_parameters': opt_parameters,
+			'pcov': pcov,
+			'converged': converged,
+			'iterations': iterations}
+
+def prepare_embryo(path):
+	# front extraction for one analysis folder, ready for fitting
+	tif, t_step_size, pixel_size = load_embryo(path)
+	DF_edge, DF_edge_max, time_end = trim_front(extract_front(tif))
+	return {'folder': os.path.basename(os.path.normpath(path)),
+			'path': path,
+			't_step_size': t_step_size,
+			'pixel_size': pixel_size,
+			'time_end': time_end,
+			'DF_edge': DF_edge,
+			'DF_edge_max': DF_edge_max}
+
+def add_fit_results(embryo, opt_parameters, pcov):
+	# fill in physical-unit parameters and per-timepoint velocity for one embryo
+	DF_edge_max = embryo['DF_edge_max']
+	real_opt_parameters, real_pcov = scale_exponential(opt_parameters, pcov, 
+													   embryo['t_step_size'], embryo['pixel_size'])
+	DF_edge_max['time_scaled'] = DF_edge_max['time'] * embryo['t_step_size'] 
+	DF_edge_max['position_scaled'] = DF_edge_max['position'] * embryo['pixel_size'] 
+	DF_edge_max.loc[:,'velocity'] = derivative_fitted_func(DF_edge_max['time_scaled'], 
+														   real_opt_parameters[1], 
+														   real_opt_parameters[2])
+	embryo['opt_parameters'] = opt_parameters
+	embryo['pcov'] = pcov
+	embryo['real_opt_parameters'] = real_opt_parameters
+	embryo['real_pcov'] = real_pcov
+	return embryo
+
+def fit_embryo(path, poly_degrees=(1, 2, 3, 4), n_replicates=0, ci_method='bootstrap'):
+	# front extraction plus polynomial and exponential fits for one analysis folder, with
+	# resampled confidence intervals if n_replicates > 0 (or ci_method is 'jackknife')
+	embryo = prepare_embryo(path)
+	DF_edge_max = embryo['DF_edge_max']
+	fits = fit_trajectories(DF_edge_max['time'], DF_edge_max['position'], poly_degrees=poly_degrees)
+	embryo['poly_coefficients'] = fits['poly_coefficients']
+	embryo['converged'] = fits['converged']
+	embryo['iterations'] = fits['iterations']
+	if not fits['converged']:
+		print("Warning: exponential fit did not converge for " + path)
+	add_fit_results(embryo, fits['opt_parameters'], fits['pcov'])
+	if n_replicates > 0 or ci_method == 'jackknife':
+		add_confidence_intervals(embryo, n_replicates=n_replicates, method=ci_method)
+	return embryo
+
+def fit_embryos(embryos, poly_degrees=(1, 2, 3, 4), n_replicates=0, ci_method='bootstrap'):
+	# fit a list of prepare_embryo results together as one stack of trajectories
+	time, position, mask = stack_trajectories([e['DF_edge_max'] for e in embryos])
+	fits = fit_trajectories(time, position, mask=mask, poly_degrees=poly_degrees)
+	for i, embryo in enumerate(embryos):
+		embryo['poly_coefficients'] = dict((deg, c[i]) for deg, c in fits['poly_coefficients'].items())
+		embryo['converged'] = fits['converged'][i]
+		embryo['iterations'] = fits['iterations'][i]
+		add_fit_results(embryo, fits['opt_parameters'][i], fits['pcov'][i])
+		if n_replicates > 0 or ci_method == 'jackknife':
+			add_confidence_intervals(embryo, n_replicates=n_replicates, method=ci_method)
+	return embryos
+
+def results_row(fit):
+	# flatten the parts of a fit_embryo result that belong in the consolidated table
+	row = {'folder': fit['folder'],
+		   'path': fit['path'],
+		   't_step_size': fit['t_step_size'],
+		   'pixel_size': fit['pixel_size'],
+		   'time_end': fit['time_end'],
+		   'converged': fit['converged'],
+		   'iterations': fit['iterations']}
+	for prefix, params, pcov in (('', fit['real_opt_parameters'], fit['real_pcov']),
+								 ('px_', fit['opt_parameters'], fit['pcov'])):
+		for i, name in enumerate(PARAMETER_NAMES):
+			row[prefix + name] = params[i]
+			for j in range(i, len(PARAMETER_NAMES)):
+				row[prefix + 'cov_' + name + '_' + PARAMETER_NAMES[j]] = pcov[i, j]
+	if 'confidence_intervals' in fit:
+		row['ci_method'] = fit['ci_method']
+		row['ci_replicates'] = fit['ci_replicates']
+		for (name, q), value in sorted(fit['confidence_intervals'].items()):
+			row['%s_p%g' % (name, q)] = value
+	for deg, z in fit['poly_coefficients'].items():
+		# highest power first, as returned by np.polyfit
+		for power, c in zip(range(deg, -1, -1), z):
+			row['poly%d_c%d' % (deg, power)] = c
+	return row
+
+def plot_fits(fit, n_points=1000):
+	# two figures - fits in pixel/frame units, and exponential fit and velocity in
+	# physical units. Fit curves are evaluated on n_points between 0 and time_end
+	DF_edge = fit['DF_edge']
+	DF_edge_max = fit['DF_edge_max']
+	time_end = fit['time_end']
+	time_end_scaled = time_end * fit['t_step_size'] 
+	poly_titles = {1: "Linear fit", 
+				   2: "Second-order polynomial fit", 
+				   3: "Third-order polynomial fit", 
+				   4: "Fourth-order polynomial fit"}
+
+	fig1 = plt.figure()
+	plt.subplot(321)
+	plt.plot(DF_edge['time'],DF_edge['position'], 'x')
+	plt.plot(DF_edge_max['time'],DF_edge_max['position'], '.')
+	plt.title("No fit")
+
+	xp = np.linspace(0, time_end, n_points)
+	for subplot, (deg, z) in enumerate(sorted(fit['poly_coefficients'].items())):
+		plt.subplot(3, 2, subplot + 2)
+		p = np.poly1d(z)
+		plt.plot(DF_edge_max['time'],DF_edge_max['position'], '.', xp, p(xp), '-')
+		plt.title(poly_titles.get(deg, "Order %d polynomial fit" % deg))
+
+	plt.subplot(326)
+	plt.plot(DF_edge_max['time'],DF_edge_max['position'], '.', 
+			 xp, fitted_func(xp, *fit['opt_parameters']), '-')
+	plt.title("Exponential fit")
+
+	plt.tight_layout()
+
+	fig2 = plt.figure()
+	plt.subplot(121)
+	tp = np.linspace(0, time_end_scaled, n_points);
+	real_opt_parameters = fit['real_opt_parameters']
+	plt.plot(DF_edge_max['time_scaled'],DF_edge_max['position_scaled'], '.',
+			 tp, fitted_func(tp, *real_opt_parameters), '-')
+
+	plt.subplot(122)
+	plt.plot(tp, derivative_fitted_func(tp, real_opt_parameters[1], 
+										real_opt_parameters[2]), '-')
+	return fig1, fig2
+
+def main(show_figures=True, excel=False):
+	# with show_figures=False no figures are created - they can be drawn later from the
+	# stored parameters with cellularization_render.py. The velocity table is added to the
+	# columnar store in the folder; excel=True also exports it to Excel as before
+	Folder = '20150601_01_sqhGFP'
+	path = '/Users/cib/Documents/CF formation imaging/Exp27/E3TL/' + Folder
+
+	fit = fit_embryo(path, n_replicates=1000)
+	pd.DataFrame([results_row(fit)]).to_csv(os.path.join(path, RESULTS_FILENAME), index=False)
+	if show_figures:
+		plot_fits(fit)
+
+	print(fit['opt_parameters'])
+	print("tau = %.3f" % fit['opt_parameters'][2])
+	print("tau 95%% CI (s) = [%.3f, %.3f]" % (fit['confidence_intervals'][('tau', 2.5)], 
+											 fit['confidence_intervals'][('tau', 97.5)]))
+
+	#plt.figure()
+	#plt.subplot(121)
+	#z = np.polyfit(DF_edge_max['time_scaled'], DF_edge_max['position_scaled'], 3)
+	#print(z)
+	#p = np.poly1d(z)
+	#xp = np.linspace(0, time_end_scaled, 1000)
+	#ax = plt.plot(DF_edge_max['time_scaled'],DF_edge_max['position_scaled'], '.', xp, p(xp), '-')
+	#
+	#plt.subplot(122)
+	#p2 = np.polyder(p)
+	#print(p2)
+	#xpxp = np.linspace(0, time_end_scaled, 1000)
+	#ax = plt.plot(xpxp, p2(xpxp), '-')
+	#Derivative = p2(xpxp)
+	#print(Derivative)
+	#
+	#
+	#DF_edge_max['velocity'] = p2(DF_edge_max['time_scaled'])
+	#DF_v_t = pd.DataFrame({'timeframe': np.arange(1, time_end + 1 , 1),
+	#                      'actual_time': np.arange(float(t_step_size), time_end_scaled + float(t_step_size), float(t_step_size)),
+	#                      'velocity': p2(np.arange(float(t_step_size), time_end_scaled + float(t_step_size), float(t_step_size)))})
+	#
+	#os.chdir(path) 
+	#DF_v_t.to_excel('time_velocity.xlsx')   
+
+	append_velocity_tables(os.path.join(path, VELOCITY_STORE_FILENAME), [embryo_velocity_table(fit)])
+	if excel:
+		DF_v_t = velocity_table(fit['time_end'], fit['t_step_size'], fit['real_opt_parameters'])
+		DF_v_t.to_excel(os.path.join(path, 'time_velocity_expo.xlsx'))
+	if show_figures:
+		plt.show()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch version of cellularization.py - finds every analysisNN_Exp_E_Ch folder produced by
+cellularization_1C.ijm below a root folder, runs front extraction for each embryo in a
+process pool, fits the polynomial and exponential models to all front trajectories as one
+stack, and writes one consolidated results table rather than one Excel file per folder.
+"""
+
+import argparse
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import cellularization as cz
+
+REQUIRED_FILES = ('cellu_front_y_t.tif', 'time_pixel_scales.txt')
+
+def find_embryo_folders(root):
+	# analysis folders are named "analysis" + iteration + "_" + Exp + "_" + E + "_" + Ch
+	folders = []
+	for dirpath, dirnames, filenames in os.walk(root):
+		if (os.path.basename(dirpath).startswith('analysis') and
+				all(f in filenames for f in REQUIRED_FILES)):
+			folders.append(dirpath)
+	return sorted(folders)
+
+def process_folder(path):
+	# worker - front extraction for one embryo. Failures are recorded in the results table
+	# rather than stopping the whole batch
+	try:
+		return cz.prepare_embryo(path), None
+	except Exception as e:
+		print("Front extraction failed for " + path + ": " + str(e))
+		traceback.print_exc()
+		return None, {'folder': os.path.basename(os.path.normpath(path)), 'path': path, 'error': repr(e)}
+
+def run_batch(root, output_path=None, processes=None, n_replicates=0, ci_method='bootstrap',
+			  velocity_store=None, excel=False):
+	# velocity tables for all embryos go to one columnar store (velocity_store, default
+	# root/time_velocity_expo.parquet), keyed by folder path relative to root; excel=True
+	# also writes the old per-folder xlsx
+	folders = find_embryo_folders(root)
+	print("Found %d embryo folders under %s" % (len(folders), root))
+	if output_path is None:
+		output_path = os.path.join(root, cz.RESULTS_FILENAME)
+	if velocity_store is None:
+		velocity_store = os.path.join(root, cz.VELOCITY_STORE_FILENAME)
+	# reading and front extraction are spread over the pool; all trajectories are then
+	# fitted together as one stack
+	if processes == 1:
+		prepared = [process_folder(f) for f in folders]
+	else:
+		with ProcessPoolExecutor(max_workers=processes) as executor:
+			prepared = list(executor.map(process_folder, folders,
+										 chunksize=max(1, len(folders) // (4 * (processes or os.cpu_count() or 1)))))
+	embryos = [embryo for embryo, failure in prepared if embryo is not None]
+	rows = [failure for embryo, failure in prepared if failure is not None]
+	velocity_tables = []
+	if embryos:
+		for embryo in cz.fit_embryos(embryos, n_replicates=n_replicates, ci_method=ci_method):
+			row = cz.results_row(embryo)
+			row['error'] = '' if embryo['converged'] else 'exponential fit did not converge'
+			rows.append(row)
+			if embryo['converged']:
+				velocity_tables.append(cz.embryo_velocity_table(embryo, root=root))
+				if excel:
+					velocity_tables[-1].drop(columns='folder').to_excel(
+						os.path.join(embryo['path'], 'time_velocity_expo.xlsx'))
+	if velocity_tables:
+		velocity_store = cz.append_velocity_tables(velocity_store, velocity_tables)
+		print("Wrote velocity tables to " + velocity_store)
+	DF_results = pd.DataFrame(rows)
+	DF_results.to_csv(output_path, index=False)
+	print("Wrote results for %d embryos (%d failed) to %s" %
+		  (len(rows), int(np.sum(DF_results['error'] != '')) if len(rows) else 0, output_path))
+	return DF_results
+
+def main():
+	parser = argparse.ArgumentParser(description="Fit cellularization front trajectories for every analysis folder below a root folder")
+	parser.add_argument('root', help="root folder to search for analysisNN_Exp_E_Ch folders")
+	parser.add_argument('-o', '--output', default=None,
+						help="consolidated results file (default: root/" + cz.RESULTS_FILENAME + ")")
+	parser.add_argument('-j', '--processes', type=int, default=None,
+						help="number of worker processes (default: number of cores)")
+	parser.add_argument('-b', '--bootstrap', type=int, default=0, metavar='N',
+						help="bootstrap confidence intervals for a, b and tau from N replicates")
+	parser.add_argument('--jackknife', action='store_true',
+						help="jackknife (leave-one-out) confidence intervals instead of bootstrap")
+	parser.add_argument('-v', '--velocity-store', default=None,
+						help="columnar store for velocity tables, .parquet, .feather or .csv (default: root/" + 
+							 cz.VELOCITY_STORE_FILENAME + ")")
+	parser.add_argument('--excel', action='store_true',
+						help="also write time_velocity_expo.xlsx in each analysis folder")
+	args = parser.parse_args()
+	run_batch(args.root, output_path=args.output, processes=args.processes, 
+			  n_replicates=args.bootstrap, ci_method=('jackknife' if args.jackknife else 'bootstrap'),
+			  velocity_store=args.velocity_store, excel=args.excel)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deferred rendering of cellularization fit figures - draws the figures of
+cellularization.plot_fits from a stored results table (as written by
+cellularization_batch.py, or by cellularization.main) instead of at fitting time. Uses
+the non-interactive Agg backend, so runs on headless nodes, and renders embryos in
+parallel in a process pool.
+"""
+
+import argparse
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+import cellularization as cz
+
+FIGURE_NAMES = ('fits_pixels.png', 'fits_scaled.png')
+
+def fit_from_row(row):
+	# rebuild the fit dictionary used by plot_fits from one row of the results table -
+	# parameters come from the table, the front itself is re-extracted from the folder
+	embryo = cz.prepare_embryo(row['path'])
+	poly_coefficients = {}
+	for deg in range(1, 100):
+		columns = ['poly%d_c%d' % (deg, power) for power in range(deg, -1, -1)]
+		if columns[0] not in row:
+			break
+		poly_coefficients[deg] = np.array([row[c] for c in columns], dtype=float)
+	embryo['poly_coefficients'] = poly_coefficients
+	opt_parameters = np.array([row['px_' + name] for name in cz.PARAMETER_NAMES], dtype=float)
+	pcov = np.full((3, 3), np.nan)
+	for i, name_i in enumerate(cz.PARAMETER_NAMES):
+		for j in range(i, len(cz.PARAMETER_NAMES)):
+			pcov[i, j] = pcov[j, i] = row['px_cov_' + name_i + '_' + cz.PARAMETER_NAMES[j]]
+	return cz.add_fit_results(embryo, opt_parameters, pcov)
+
+def render_row(args):
+	# worker - draw and save both figures for one embryo, returning the files written
+	row, output_dir, n_points, dpi = args
+	try:
+		figures = cz.plot_fits(fit_from_row(row), n_points=n_points)
+	except Exception as e:
+		print("Rendering failed for " + str(row.get('path')) + ": " + str(e))
+		traceback.print_exc()
+		return []
+	filenames = []
+	for fig, name in zip(figures, FIGURE_NAMES):
+		if output_dir is None:
+			filename = os.path.join(row['path'], name)
+		else:
+			filename = os.path.join(output_dir, row['folder'] + '_' + name)
+		fig.savefig(filename, dpi=dpi)
+		plt.close(fig)
+		filenames.append(filename)
+	return filenames
+
+def render_results(results_path, output_dir=None, folders=None, n_points=200, dpi=100, processes=None):
+	# render figures for every successfully fitted embryo in the results table, or only
+	# those in folders. Figures go to each embryo's folder unless output_dir is given
+	DF_results = pd.read_csv(results_path, keep_default_na=False, na_values=[''])
+	if 'error' in DF_results:
+		DF_results = DF_results[DF_results['error'].isnull()]
+	if folders is not None:
+		DF_results = DF_results[DF_results['folder'].isin(folders)]
+	if output_dir is not None and not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+	jobs = [(row, output_dir, n_points, dpi) for row in DF_results.to_dict('records')]
+	if processes == 1:
+		written = [render_row(job) for job in jobs]
+	else:
+		with ProcessPoolExecutor(max_workers=processes) as executor:
+			written = list(executor.map(render_row, jobs))
+	print("Rendered figures for %d of %d embryos" % (sum(1 for w in written if w), len(jobs)))
+	return [f for w in written for f in w]
+
+def main():
+	parser = argparse.ArgumentParser(description="Render cellularization fit figures from a stored results table")
+	parser.add_argument('results', help="results table written by cellularization_batch.py")
+	parser.add_argument('-o', '--output-dir', default=None,
+						help="folder for figures (default: each embryo's analysis folder)")
+	parser.add_argument('-f', '--folder', action='append', default=None,
+						help="only render this analysis folder name (may be repeated)")
+	parser.add_argument('-n', '--points', type=int, default=200,
+						help="number of points along each fitted curve")
+	parser.add_argument('--dpi', type=int, default=100)
+	parser.add_argument('-j', '--processes', type=int, default=None,
+						help="number of worker processes (default: number of cores)")
+	args = parser.parse_args()
+	render_results(args.results, output_dir=args.output_dir, folders=args.folder,
+				   n_points=args.points, dpi=args.dpi, processes=args.processes)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NumPy replacement for the kymograph step of cellularization_1C.ijm. Re-samples the line
+recorded in Kymo_segment_cdn.txt from the <Ch>_initial_input.tif stack saved by the macro,
+for every frame in one interpolation call, and writes only the kymograph and
+time_pixel_scales.txt - no Kymo_processmethod/Kymo_seg intermediate copies - so that
+kymographs can be regenerated for many embryos without ImageJ.
+"""
+
+import argparse
+import glob
+import os
+import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.ndimage as ndi
+from skimage import io
+
+CDN_FILENAME = 'Kymo_segment_cdn.txt'
+SCALES_FILENAME = 'time_pixel_scales.txt'
+KYMOGRAPH_FILENAME = 'Kymo_raw.tif'
+INPUT_PATTERN = '*_initial_input.tif'
+
+def read_line_coordinates(cdn_path):
+	# x1, y1, x2, y2 as printed by the macro, e.g.
+	# "Kymograph line segment coordinates:102 15 98 160"
+	with open(cdn_path, 'r') as f:
+		numbers = re.findall(r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?', f.read().split(':')[-1])
+	if len(numbers) < 4:
+		raise ValueError("Couldn't find line coordinates in " + cdn_path)
+	return tuple(float(n) for n in numbers[:4])
+
+def line_sample_points(x1, y1, x2, y2, line_width=1):
+	# sample positions along the line at 1 pixel spacing, end points included, as ImageJ's
+	# ImageProcessor.getLine. For line_width > 1 the line is offset perpendicular to itself
+	# at 1 pixel spacing, centred on the drawn line. Returns (line_width, n_points) x and y
+	dx, dy = x2 - x1, y2 - y1
+	length = np.hypot(dx, dy)
+	n = int(round(length))
+	s = np.linspace(0, 1, n + 1)
+	offsets = np.arange(line_width) - (line_width - 1) / 2.0
+	nx, ny = (-dy / length, dx / length) if length > 0 else (0.0, 0.0)
+	xs = x1 + s[None, :] * dx + offsets[:, None] * nx
+	ys = y1 + s[None, :] * dy + offsets[:, None] * ny
+	return xs, ys
+
+def build_kymograph(stack, line, line_width=1, blur_sigma=None):
+	# (frames, height, width) stack -> (frames, n_points) kymograph, time down the rows and
+	# position along the line across the columns, averaged over line_width. The whole
+	# stack is sampled with one bilinear map_coordinates call. blur_sigma applies the
+	# macro's per-frame Gaussian preprocessing first
+	stack = np.asarray(stack)
+	if stack.ndim == 2:
+		stack = stack[None]
+	data = stack.astype(np.float32)
+	if blur_sigma:
+		data = ndi.gaussian_filter(data, sigma=(0, blur_sigma, blur_sigma))
+	xs, ys = line_sample_points(*line, line_width=line_width)
+	frames = stack.shape[0]
+	coords = np.empty((3, frames) + xs.shape, dtype=np.float32)
+	coords[0] = np.arange(frames)[:, None, None]
+	coords[1] = ys[None]
+	coords[2] = xs[None]
+	samples = ndi.map_coordinates(data, coords, order=1, mode='nearest')
+	kymo = samples.mean(axis=1)
+	if np.issubdtype(stack.dtype, np.integer):
+		info = np.iinfo(stack.dtype)
+		kymo = np.clip(np.round(kymo), info.min, info.max)
+	return kymo.astype(stack.dtype)
+
+def write_scales(folder, t_step_size, pixel_size):
+	with open(os.path.join(folder, SCALES_FILENAME), 'w') as f:
+		f.write("t_step_size pixel_size\n")
+		f.write(str(t_step_size) + " " + str(pixel_size) + "\n")
+
+def build_folder_kymograph(folder, line_width=1, blur_sigma=3, t_step_size=None, pixel_size=None):
+	# regenerate the kymograph for one analysisNN_Exp_E_Ch folder. Time/pixel scales are
+	# kept from an existing time_pixel_scales.txt unless given
+	inputs = sorted(glob.glob(os.path.join(folder, INPUT_PATTERN)))
+	if not inputs:
+		raise IOError("No " + INPUT_PATTERN + " stack in " + folder)
+	line = read_line_coordinates(os.path.join(folder, CDN_FILENAME))
+	kymo = build_kymograph(io.imread(inputs[0]), line, line_width=line_width, blur_sigma=blur_sigma)
+	io.imsave(os.path.join(folder, KYMOGRAPH_FILENAME), kymo, check_contrast=False)
+	scales_path = os.path.join(folder, SCALES_FILENAME)
+	if t_step_size is None or pixel_size is None:
+		if not os.path.isfile(scales_path):
+			raise IOError("No " + SCALES_FILENAME + " in " + folder + " - time step and pixel size must be given")
+		DF_txt = pd.read_csv(scales_path, sep=' ')
+		t_step_size = DF_txt.iloc[0, 0] if t_step_size is None else t_step_size
+		pixel_size = DF_txt.iloc[0, 1] if pixel_size is None else pixel_size
+	write_scales(folder, t_step_size, pixel_size)
+	return kymo
+
+def find_kymograph_folders(root):
+	folders = []
+	for dirpath, dirnames, filenames in os.walk(root):
+		if CDN_FILENAME in filenames and glob.glob(os.path.join(dirpath, INPUT_PATTERN)):
+			folders.append(dirpath)
+	return sorted(folders)
+
+def process_folder(args):
+	folder, kwargs = args
+	try:
+		build_folder_kymograph(folder, **kwargs)
+		return True
+	except Exception as e:
+		print("Kymograph failed for " + folder + ": " + str(e))
+		traceback.print_exc()
+		return False
+
+def main():
+	parser = argparse.ArgumentParser(description="Build kymographs for every analysis folder below a root folder")
+	parser.add_argument('root', help="root folder to search for analysis folders with " + CDN_FILENAME)
+	parser.add_argument('-w', '--line-width', type=int, default=1)
+	parser.add_argument('-s', '--blur-sigma', type=float, default=3,
+						help="per-frame Gaussian blur before sampling, as the macro (0 for none)")
+	parser.add_argument('-t', '--t-step', type=float, default=None, help="frame interval, s")
+	parser.add_argument('-p', '--pixel-size', type=float, default=None, help="pixel size, um")
+	parser.add_argument('-j', '--processes', type=int, default=None,
+						help="number of worker processes (default: number of cores)")
+	args = parser.parse_args()
+	kwargs = {'line_width': args.line_width, 'blur_sigma': args.blur_sigma,
+			  't_step_size': args.t_step, 'pixel_size': args.pixel_size}
+	jobs = [(folder, kwargs) for folder in find_kymograph_folders(args.root)]
+	with ProcessPoolExecutor(max_workers=args.processes) as executor:
+		ok = list(executor.map(process_folder, jobs))
+	print("Built %d of %d kymographs" % (sum(ok), len(jobs)))
+
+if __name__ == '__main__':
+	main()
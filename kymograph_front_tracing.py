@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Automatic replacement for the "Use magic wand to select basal margin" step of
+cellularization_1C.ijm and cellularization_1C_105.ijm. Labels the connected components of
+the segmented kymograph (Kymo_seg.tif from kymograph_segmentation.py), keeps the largest
+component touching the top (first analysed) row as the basal margin, and writes it as
+cellu_front_y_t.tif. Fronts already traced by hand are kept (the automatic one goes to
+cellu_front_y_t_auto.tif) unless --overwrite is given. Embryos where the traced margin
+looks unreliable are listed for manual review rather than stopping the run.
+"""
+
+import argparse
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.ndimage as ndi
+from skimage import io
+
+import kymograph_segmentation as ks
+
+REVIEW_FILENAME = 'front_tracing_review.csv'
+EIGHT_CONNECTED = np.ones((3, 3), dtype=bool)
+
+def trace_basal_margin(seg, min_coverage=0.95, max_jump=5, max_jump_fraction=0.05, min_area_fraction=0.2):
+	# returns the 0/255 image of the traced margin and a dictionary of confidence measures:
+	# coverage - fraction of rows from the top row to the last foreground row in which the
+	# margin is present; jump_fraction - fraction of consecutive rows where the front
+	# (first margin column) moves by more than max_jump pixels; area_fraction - share of
+	# all foreground pixels in the margin component. flagged/reasons mark low confidence
+	foreground = np.asarray(seg) > 0
+	labels, n_labels = ndi.label(foreground, structure=EIGHT_CONNECTED)
+	qc = {'components': n_labels, 'coverage': 0.0, 'jump_fraction': np.nan,
+		  'max_front_jump': np.nan, 'area_fraction': 0.0, 'flagged': True, 'reasons': ''}
+	rows = np.flatnonzero(foreground.any(axis=1))
+	if n_labels == 0:
+		qc['reasons'] = 'empty segmentation'
+		return np.zeros(foreground.shape, dtype=np.uint8), qc
+	top, bottom = rows[0], rows[-1]
+
+	# largest component touching the top row
+	top_labels = np.unique(labels[top][labels[top] > 0])
+	areas = ndi.sum_labels(foreground, labels, index=top_labels)
+	margin_label = top_labels[np.argmax(areas)]
+	margin = (labels == margin_label)
+
+	has_front = margin.any(axis=1)
+	front = margin.argmax(axis=1)[has_front]
+	jumps = np.abs(np.diff(front))
+	qc['coverage'] = has_front[top:bottom + 1].mean()
+	qc['jump_fraction'] = (jumps > max_jump).mean() if len(jumps) else 0.0
+	qc['max_front_jump'] = jumps.max() if len(jumps) else 0
+	qc['area_fraction'] = margin.sum() / float(foreground.sum())
+
+	reasons = []
+	if qc['coverage'] < min_coverage:
+		reasons.append('margin missing in %.0f%% of rows' % (100 * (1 - qc['coverage'])))
+	if qc['jump_fraction'] > max_jump_fraction:
+		reasons.append('front jumps > %d px in %.0f%% of rows' % (max_jump, 100 * qc['jump_fraction']))
+	if qc['area_fraction'] < min_area_fraction:
+		reasons.append('margin is only %.0f%% of segmented area' % (100 * qc['area_fraction']))
+	qc['flagged'] = bool(reasons)
+	qc['reasons'] = '; '.join(reasons)
+	return margin.astype(np.uint8) * 255, qc
+
+def trace_folder(folder, overwrite=False, **kwargs):
+	margin, qc = trace_basal_margin(io.imread(os.path.join(folder, ks.SEGMENTATION_FILENAME)), **kwargs)
+	qc['kept_hand_traced'] = not ks.write_front(folder, margin, overwrite=overwrite)
+	return qc
+
+def find_segmented_folders(root):
+	return sorted(dirpath for dirpath, dirnames, filenames in os.walk(root)
+				  if ks.SEGMENTATION_FILENAME in filenames)
+
+def process_folder(args):
+	folder, kwargs = args
+	try:
+		qc = trace_folder(folder, **kwargs)
+	except Exception as e:
+		print("Front tracing failed for " + folder + ": " + str(e))
+		traceback.print_exc()
+		qc = {'flagged': True, 'reasons': 'tracing failed: ' + repr(e)}
+	qc['folder'] = os.path.basename(os.path.normpath(folder))
+	qc['path'] = folder
+	return qc
+
+def trace_all(root, review_path=None, processes=None, **kwargs):
+	jobs = [(folder, kwargs) for folder in find_segmented_folders(root)]
+	with ProcessPoolExecutor(max_workers=processes) as executor:
+		results = list(executor.map(process_folder, jobs))
+	if review_path is None:
+		review_path = os.path.join(root, REVIEW_FILENAME)
+	DF_review = pd.DataFrame(results, columns=['folder', 'path', 'flagged', 'reasons', 'kept_hand_traced',
+											   'coverage', 'jump_fraction', 'max_front_jump',
+											   'area_fraction', 'components'])
+	DF_review.to_csv(review_path, index=False)
+	n_flagged = int(DF_review['flagged'].sum()) if len(DF_review) else 0
+	n_kept = int((DF_review['kept_hand_traced'] == True).sum()) if len(DF_review) else 0
+	print("Traced %d kymographs, %d flagged for manual review in %s" % (len(results), n_flagged, review_path))
+	if n_kept:
+		print("Kept %d hand-traced %s files - the automatic fronts are in %s" %
+			  (n_kept, ks.FRONT_FILENAME, ks.AUTOMATIC_FRONT_FILENAME))
+	return DF_review
+
+def main():
+	parser = argparse.ArgumentParser(description="Trace the basal margin in the segmented kymograph of every analysis folder below a root folder")
+	parser.add_argument('root')
+	parser.add_argument('-o', '--review', default=None,
+						help="review table (default: root/" + REVIEW_FILENAME + ")")
+	parser.add_argument('--min-coverage', type=float, default=0.95)
+	parser.add_argument('--max-jump', type=int, default=5)
+	parser.add_argument('--max-jump-fraction', type=float, default=0.05)
+	parser.add_argument('--min-area-fraction', type=float, default=0.2)
+	parser.add_argument('-j', '--processes', type=int, default=None,
+						help="number of worker processes (default: number of cores)")
+	parser.add_argument('--overwrite', action='store_true',
+						help="replace " + ks.FRONT_FILENAME + " files that were traced by hand")
+	args = parser.parse_args()
+	trace_all(args.root, review_path=args.review, processes=args.processes, overwrite=args.overwrite,
+			  min_coverage=args.min_coverage, max_jump=args.max_jump,
+			  max_jump_fraction=args.max_jump_fraction, min_area_fraction=args.min_area_fraction)
+
+if __name__ == '__main__':
+	main()
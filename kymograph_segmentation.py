@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Python segmentation stage for cellularization kymographs, replacing the Gaussian blur,
+Median and Auto Local Threshold steps of cellularization_1C.ijm and
+cellularization_1C_105.ijm. Local statistics are O(1) per pixel whatever the radius:
+mean/standard deviation (for mean, Niblack and Sauvola thresholds) come from integral
+images, and local histograms (for local Otsu and median) from per-column histograms
+updated as the window slides down the image. Windows are square, (2*radius + 1) wide, and
+clipped at the image edges, rather than ImageJ's circular kernels.
+"""
+
+import argparse
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.ndimage as ndi
+from skimage import io
+
+KYMOGRAPH_FILENAME = 'Kymo_raw.tif'
+SEGMENTATION_FILENAME = 'Kymo_seg.tif'
+FRONT_FILENAME = 'cellu_front_y_t.tif'
+AUTOMATIC_FRONT_FILENAME = 'cellu_front_y_t_auto.tif'
+METHODS = ('mean', 'median', 'niblack', 'sauvola', 'otsu')
+
+def window_bounds(n, radius):
+	i = np.arange(n)
+	return np.clip(i - radius, 0, n), np.clip(i + radius + 1, 0, n)
+
+def integral_image(image, dtype=np.float64):
+	# zero-padded so that the sum over [y0, y1) x [x0, x1) is
+	# ii[y1, x1] - ii[y0, x1] - ii[y1, x0] + ii[y0, x0]
+	ii = np.zeros((image.shape[0] + 1, image.shape[1] + 1) + image.shape[2:], dtype=dtype)
+	np.cumsum(image, axis=0, dtype=dtype, out=ii[1:, 1:])
+	np.cumsum(ii[1:, 1:], axis=1, out=ii[1:, 1:])
+	return ii
+
+def box_sum(ii, y0, y1, x0, x1):
+	return (ii[y1][:, x1] - ii[y0][:, x1] - ii[y1][:, x0] + ii[y0][:, x0])
+
+def local_mean_std(image, radius):
+	image = np.asarray(image, dtype=np.float64)
+	y0, y1 = window_bounds(image.shape[0], radius)
+	x0, x1 = window_bounds(image.shape[1], radius)
+	count = ((y1 - y0)[:, None] * (x1 - x0)[None, :]).astype(np.float64)
+	mean = box_sum(integral_image(image), y0, y1, x0, x1) / count
+	mean_sq = box_sum(integral_image(image * image), y0, y1, x0, x1) / count
+	return mean, np.sqrt(np.maximum(mean_sq - mean * mean, 0))
+
+def quantize(image, bins=256):
+	# grey levels 0..bins-1; 8-bit images with bins=256 are unchanged
+	image = np.asarray(image)
+	if image.dtype == np.uint8 and bins == 256:
+		return image
+	lo, hi = float(image.min()), float(image.max())
+	scale = (bins - 1) / (hi - lo) if hi > lo else 0.0
+	return np.round((image.astype(np.float64) - lo) * scale).astype(np.intp)
+
+def local_histograms(levels, radius, bins=256, max_bytes=64 * 2 ** 20):
+	# yields (row_start, row_stop, histograms) with histograms (rows, width, bins) of the
+	# window around each pixel, in row chunks of at most max_bytes. The histogram of each
+	# column over the current rows of the window is kept and updated as the window slides
+	# down (one row in, one row out), and each row's window histograms are box sums of
+	# those along x - so the cost per pixel doesn't depend on the radius
+	height, width = levels.shape
+	y0, y1 = window_bounds(height, radius)
+	x0, x1 = window_bounds(width, radius)
+	chunk = max(1, int(max_bytes // (4 * width * bins)))
+	columns = np.arange(width)
+	column_hist = np.zeros((width, bins), dtype=np.int32)
+	cumulative = np.zeros((width + 1, bins), dtype=np.int32)
+	top = bottom = 0
+	for start in range(0, height, chunk):
+		stop = min(height, start + chunk)
+		hist = np.empty((stop - start, width, bins), dtype=np.int32)
+		for y in range(start, stop):
+			for row in range(bottom, y1[y]):
+				column_hist[columns, levels[row]] += 1
+			for row in range(top, y0[y]):
+				column_hist[columns, levels[row]] -= 1
+			top, bottom = y0[y], y1[y]
+			np.cumsum(column_hist, axis=0, out=cumulative[1:])
+			np.subtract(cumulative[x1], cumulative[x0], out=hist[y - start])
+		yield start, stop, hist
+
+def otsu_from_histograms(hist):
+	# Otsu threshold (bin index) for each histogram along the last axis
+	hist = hist.astype(np.float64)
+	levels = np.arange(hist.shape[-1])
+	w0 = np.cumsum(hist, axis=-1)
+	n = w0[..., -1:]
+	mu = np.cumsum(hist * levels, axis=-1)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		between = (mu[..., -1:] * w0 - mu * n) ** 2 / (w0 * (n - w0))
+	return np.argmax(np.nan_to_num(between, nan=-1.0), axis=-1)
+
+def median_from_histograms(hist):
+	cumulative = np.cumsum(hist, axis=-1)
+	return np.argmax(cumulative * 2 >= cumulative[..., -1:], axis=-1)
+
+def local_histogram_filter(image, radius, statistic, bins=256):
+	# local Otsu threshold or median of image, as grey levels of quantize(image, bins)
+	levels = quantize(image, bins)
+	out = np.empty(levels.shape, dtype=np.intp)
+	for start, stop, hist in local_histograms(levels, radius, bins=bins):
+		out[start:stop] = statistic(hist)
+	return levels, out
+
+def median_filter(image, radius, bins=256):
+	levels, median = local_histogram_filter(image, radius, median_from_histograms, bins=bins)
+	return median
+
+def local_threshold(image, method='otsu', radius=15, k=None, r=128.0, c=0.0, bins=256):
+	# binary mask (True = object, bright) with ImageJ Auto Local Threshold's definitions:
+	# mean: pixel > mean - c; median: pixel > median - c; niblack: pixel > mean + k*sd - c
+	# (k default 0.2); sauvola: pixel > mean*(1 + k*(sd/r - 1)) (k default 0.5);
+	# otsu: pixel > local Otsu threshold
+	if method in ('mean', 'niblack', 'sauvola'):
+		image = np.asarray(image, dtype=np.float64)
+		mean, sd = local_mean_std(image, radius)
+		if method == 'mean':
+			return image > mean - c
+		if method == 'niblack':
+			return image > mean + (0.2 if k is None else k) * sd - c
+		return image > mean * (1 + (0.5 if k is None else k) * (sd / r - 1))
+	if method == 'otsu':
+		levels, threshold = local_histogram_filter(image, radius, otsu_from_histograms, bins=bins)
+		return levels > threshold
+	if method == 'median':
+		levels, median = local_histogram_filter(image, radius, median_from_histograms, bins=bins)
+		return levels > median - c
+	raise ValueError("Unknown local threshold method " + str(method) + ", should be one of " + str(METHODS))
+
+def segment_kymograph(kymo, method='otsu', radius=15, blur_sigma=3, median_radius=None,
+					  final_t=None, **threshold_kwargs):
+	# binary (0/255 uint8) kymograph, as the "white" output of Auto Local Threshold.
+	# blur_sigma and median_radius are the preprocessing of cellularization_1C.ijm and
+	# cellularization_1C_105.ijm respectively; final_t clears rows outside 1..final_t, as
+	# the macro's makeRectangle(0, 1, width, final_t) and Clear Outside
+	image = np.asarray(kymo, dtype=np.float64)
+	if blur_sigma:
+		image = ndi.gaussian_filter(image, blur_sigma)
+	if median_radius:
+		image = median_filter(image, median_radius)
+	mask = local_threshold(image, method=method, radius=radius, **threshold_kwargs)
+	if final_t is not None:
+		mask[0] = False
+		mask[int(final_t) + 1:] = False
+	return mask.astype(np.uint8) * 255
+
+def front_is_automatic(folder):
+	# True if cellu_front_y_t.tif is missing or is the last front written by write_front,
+	# False if it was made some other way (traced by hand with the macros' magic wand)
+	front_path = os.path.join(folder, FRONT_FILENAME)
+	if not os.path.isfile(front_path):
+		return True
+	automatic_path = os.path.join(folder, AUTOMATIC_FRONT_FILENAME)
+	return os.path.isfile(automatic_path) and np.array_equal(io.imread(front_path), io.imread(automatic_path))
+
+def write_front(folder, front, overwrite=False):
+	# the front is always written as cellu_front_y_t_auto.tif, and as cellu_front_y_t.tif for
+	# cellularization.py unless that holds a front traced by hand (or overwrite is set).
+	# Returns whether cellu_front_y_t.tif was written
+	replace = overwrite or front_is_automatic(folder)
+	io.imsave(os.path.join(folder, AUTOMATIC_FRONT_FILENAME), front, check_contrast=False)
+	if replace:
+		io.imsave(os.path.join(folder, FRONT_FILENAME), front, check_contrast=False)
+	return replace
+
+def segment_folder(folder, overwrite=False, **kwargs):
+	# the segmentation is kept as Kymo_seg.tif, so that kymograph_front_tracing.py can be
+	# rerun on it, and also written as the front for cellularization.py with write_front
+	kymo = io.imread(os.path.join(folder, KYMOGRAPH_FILENAME))
+	seg = segment_kymograph(kymo, **kwargs)
+	io.imsave(os.path.join(folder, SEGMENTATION_FILENAME), seg, check_contrast=False)
+	if not write_front(folder, seg, overwrite=overwrite):
+		print("Kept the hand-traced " + FRONT_FILENAME + " in " + folder)
+	return seg
+
+def find_kymograph_folders(root):
+	return sorted(dirpath for dirpath, dirnames, filenames in os.walk(root)
+				  if KYMOGRAPH_FILENAME in filenames)
+
+def process_folder(args):
+	folder, kwargs = args
+	try:
+		segment_folder(folder, **kwargs)
+		return True
+	except Exception as e:
+		print("Segmentation failed for " + folder + ": " + str(e))
+		traceback.print_exc()
+		return False
+
+def main():
+	parser = argparse.ArgumentParser(description="Segment the kymograph (" + KYMOGRAPH_FILENAME +
+									 ") of every analysis folder below a root folder")
+	parser.add_argument('root')
+	parser.add_argument('-m', '--method', choices=METHODS, default='otsu')
+	parser.add_argument('-r', '--radius', type=int, default=15)
+	parser.add_argument('-k', type=float, default=None, help="Niblack/Sauvola k")
+	parser.add_argument('-c', type=float, default=0.0, help="offset for mean/median/Niblack")
+	parser.add_argument('-s', '--blur-sigma', type=float, default=3)
+	parser.add_argument('--median-radius', type=int, default=None)
+	parser.add_argument('--final-t', type=int, default=None, help="last frame of the analysis")
+	parser.add_argument('-j', '--processes', type=int, default=None,
+						help="number of worker processes (default: number of cores)")
+	parser.add_argument('--overwrite', action='store_true',
+						help="replace " + FRONT_FILENAME + " files that were traced by hand")
+	args = parser.parse_args()
+	kwargs = {'method': args.method, 'radius': args.radius, 'k': args.k, 'c': args.c,
+			  'blur_sigma': args.blur_sigma, 'median_radius': args.median_radius,
+			  'final_t': args.final_t, 'overwrite': args.overwrite}
+	jobs = [(folder, kwargs) for folder in find_kymograph_folders(args.root)]
+	with ProcessPoolExecutor(max_workers=args.processes) as executor:
+		ok = list(executor.map(process_folder, jobs))
+	print("Segmented %d of %d kymographs" % (sum(ok), len(jobs)))
+
+if __name__ == '__main__':
+	main()
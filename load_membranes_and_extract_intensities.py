@@ -4,6 +4,11 @@ import json, os, csv
 from ij import IJ
 from ij.gui import WaitForUserDialog, PolygonRoi, Roi
 from ij.io import OpenDialog
+try:
+	# binary membrane container - needs membrane_file.py on the Jython path
+	import membrane_file
+except ImportError:
+	membrane_file = None
 
 line_width = 1;
 default_edges_path = "C:\\Users\\dougk\\Desktop\\Membranes 2019-01-11 15-24-07.json";
@@ -14,14 +19,34 @@ settings_file_name = "MembraneEvolutionAnalysisSettings.json";
 # assume settings file and edges file are in the same directory...
 settings_file_path = os.path.join(os.path.dirname(edges_file_path), settings_file_name);
 
-f = open(edges_file_path, 'r');
-try:
-	edges_dct = json.loads(f.read());
-finally:
-	f.close();
+# use the binary container written alongside the JSON if there is one - membranes are then read from 
+# it as needed rather than parsing the whole file
+membranes_file = None;
+if membrane_file is not None and os.path.isfile(membrane_file.binary_path_for(edges_file_path)):
+	membranes_file = membrane_file.MembraneFile(membrane_file.binary_path_for(edges_file_path));
+	timepoints = membranes_file.timepoints;
+else:
+	f = open(edges_file_path, 'r');
+	try:
+		edges_dct = json.loads(f.read());
+	finally:
+		f.close();
+	timepoints = edges_dct;
+
+def membrane_positions(idx):
+	if membranes_file is not None:
+		return membranes_file.positions(idx);
+	return [membrane['position number'] for membrane in edges_dct[idx]['membranes']];
+
+def membrane_xy(idx, membrane_index):
+	if membranes_file is not None:
+		return membranes_file.get(idx, membrane_index);
+	membranes = edges_dct[idx]['membranes'];
+	membrane_xy_list = membranes[membrane_positions(idx).index(membrane_index)]['roi'];
+	return [x for x, y in membrane_xy_list], [y for x, y in membrane_xy_list];
 
 # check if open image corresponds to selected edge data...
-original_image_file = edges_dct[0]['input_image_title'];
+original_image_file = timepoints[0]['input_image_title'];
 if imp.getTitle() is not original_image_file:
 	WaitForUserDialog("WARNING!", 
 					("Open image title is " + str(imp.getTitle()) + ", whilst edge file was generated on " + 
@@ -64,18 +89,16 @@ frames_subset = [f + 1 for f in range(start_frame-1, end_frame, int(analysis_fra
 # note - change line width parameter at the top of code to adjust the width of the line that intensity stats are calculated over...
 output = [];
 for idx, frame_idx in enumerate(frames_subset):
-	if frame_idx > len(edges_dct) - 1:
+	if frame_idx > len(timepoints) - 1:
 		break;
 #	imp.setSlice(frame_idx);
 	imp.setT(frame_idx);
-	timepoint_data = edges_dct[idx];
-	t = timepoint_data['time_point_s'];
-	membranes = timepoint_data['membranes'];
-	membrane_indices_available = [membrane['position number'] for membrane in membranes];
+	t = timepoints[idx]['time_point_s'];
+	membrane_indices_available = membrane_positions(idx);
 	for membrane_index in membrane_indices_available:
 		print("Analysing frame " + str(frame_idx) + ", membrane_index = " + str(membrane_index));
-		membrane_xy_list = membranes[membrane_indices_available.index(membrane_index)]['roi'];
-		roi = PolygonRoi([x for x, y in membrane_xy_list], [y for x, y in membrane_xy_list], Roi.FREELINE);
+		xs, ys = membrane_xy(idx, membrane_index);
+		roi = PolygonRoi(xs, ys, Roi.FREELINE);
 		imp.setRoi(roi);
 		roi.setStrokeWidth(line_width);
 		if line_width > 1:	
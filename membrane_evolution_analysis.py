@@ -1,9 +1,51 @@
 import math, csv, json, os
+from array import array
 from datetime import datetime
-from ij import IJ, ImageListener;
-from ij.gui import Line, NonBlockingGenericDialog, GenericDialog, WaitForUserDialog
+from ij import IJ, ImageListener, ImagePlus, VirtualStack;
+from ij.gui import Line, NonBlockingGenericDialog, GenericDialog, PolygonRoi, Roi, WaitForUserDialog
+from ij.process import FloatPolygon
 from ij.io import DirectoryChooser
-from ij.plugin import SubstackMaker
+from java.lang import System
+try:
+	# binary membrane container - needs membrane_file.py on the Jython path
+	import membrane_file
+except ImportError:
+	membrane_file = None
+
+JOURNAL_EXTENSION = ".journal";
+
+class StridedStackView(VirtualStack):
+	"""read-only view of some planes of another stack, without copying - planes come from the source stack 
+	as they are displayed, so a file-backed virtual source is read from disk lazily"""
+
+	def __init__(self, source_stack, indices):
+		VirtualStack.__init__(self, source_stack.getWidth(), source_stack.getHeight(), None, None);
+		self.source_stack = source_stack;
+		self.indices = list(indices); # 1-indexed source planes, in view order
+
+	def getSize(self):
+		return len(self.indices);
+
+	def getProcessor(self, n):
+		return self.source_stack.getProcessor(self.indices[n - 1]);
+
+	def getPixels(self, n):
+		return self.source_stack.getPixels(self.indices[n - 1]);
+
+	def getSliceLabel(self, n):
+		return self.source_stack.getSliceLabel(self.indices[n - 1]);
+
+	def getBitDepth(self):
+		return self.source_stack.getBitDepth();
+
+def strided_substack_view(imp, frames):
+	"""image of the given (1-indexed) frames of imp as consecutive slices, as SubstackMaker would make, but 
+	sharing imp's data. imp must stay open (it can be hidden) while the view is used"""
+	view = StridedStackView(imp.getStack(), [imp.getStackIndex(imp.getC(), imp.getZ(), f) for f in frames]);
+	view_imp = ImagePlus("Substack (" + str(frames[0]) + "-" + str(frames[-1]) + "-" + 
+						str(frames[1] - frames[0] if len(frames) > 1 else 1) + ")", view);
+	view_imp.setCalibration(imp.getCalibration());
+	return view_imp;
 
 class MembraneEvolutionAnalysisSettings:
 	"""class to hold settings and allow persistence between instances"""
@@ -62,55 +104,105 @@ class MembraneEvolutionAnalysisSettings:
 		return settings_path;
 		
 class DrawnMembrane:
-	"""class for manually-drawn membranes"""
+	"""class for manually-drawn membranes. Coordinates are held in float32 arrays rather than as a live 
+	roi, which is only built when needed"""
 	
 	def __init__(self, roi=None, positionNumber=0):
-		self.roi=roi;
 		self.positionNumber=positionNumber;
+		self.xpoints = None;
+		self.ypoints = None;
+		self.roi_type = Roi.FREELINE;
+		self.segment = None; # id of the journal segment (drawing session) it was recorded in
+		if roi is not None:
+			self._storeRoi(roi);
+		self._clearGeometry();
+
+	def _storeRoi(self, roi):
+		poly = roi.getFloatPolygon();
+		self.xpoints = array('f', poly.xpoints);
+		self.ypoints = array('f', poly.ypoints);
+		self.roi_type = roi.getType();
+
+	def _clearGeometry(self):
+		"""forget the interpolated polygon and measurements, to be recalculated for the current roi"""
+		self._interpolated_polygon = None;
+		self._measurements = None;
 
 	def setRoi(self, roi):
 		"""define roi describing the membrane"""
 		if not roi.isArea():
-			self.roi=roi;	
+			self._storeRoi(roi);
+			self._clearGeometry();
 
 	def getRoi(self):
-		"""return the roi describing the membrane"""
-		return self.roi;
+		"""return a new roi describing the membrane, or None if there isn't one"""
+		if self.xpoints is None:
+			return None;
+		if self.roi_type == Roi.LINE:
+			return Line(self.xpoints[0], self.ypoints[0], self.xpoints[-1], self.ypoints[-1]);
+		# PolygonRoi keeps the arrays it is given and moves them with the roi, so give it copies
+		return PolygonRoi(FloatPolygon(array('f', self.xpoints), array('f', self.ypoints)), self.roi_type);
+
+	def getPoints(self):
+		"""return the membrane's points as a list of (x, y)"""
+		return [(x, y) for x, y in zip(self.xpoints, self.ypoints)];
+
+	def matchesRoi(self, roi):
+		"""return True if roi has the same type and (float32) points as this membrane"""
+		if self.xpoints is None or roi.getType() != self.roi_type:
+			return False;
+		poly = roi.getFloatPolygon();
+		return array('f', poly.xpoints) == self.xpoints and array('f', poly.ypoints) == self.ypoints;
 
 	def setPositionNumber(self, number):
 		"""define the interface index described in CB diagrams that this membrane corresponds to"""
 		self.positionNumber=int(number);
 
+	def getInterpolatedPolygon(self):
+		"""return the roi interpolated at 1 pixel spacing with 3-point smoothing, calculated once per roi"""
+		if self._interpolated_polygon is None:
+			self._interpolated_polygon = self.getRoi().getInterpolatedPolygon(1, True);
+		return self._interpolated_polygon;
+
+	def measure(self):
+		"""return a dictionary of path length, euclidean length and sinuosity (lengths in pixels), 
+		calculated once per roi"""
+		if self._measurements is None:
+			poly = self.getInterpolatedPolygon();
+			path_length = poly.getLength(True);
+			euclidean = Line(poly.xpoints[0], poly.ypoints[0], poly.xpoints[-1], poly.ypoints[-1]).getLength();
+			self._measurements = {"path length" : path_length, 
+									"euclidean" : euclidean, 
+									"sinuosity" : path_length/euclidean - 1};
+		return self._measurements;
+
 	def getEuclidean(self):
 		"""return the length of the straight line joining start and end points of the membrane"""
-		poly = self.roi.getInterpolatedPolygon(1, True);
-		line = Line(poly.xpoints[0], poly.ypoints[0], poly.xpoints[-1], poly.ypoints[-1]);
-		return line.getLength();
+		return self.measure()["euclidean"];
 
 	def getPathLength(self):
 		"""return the length of the membrane - automatically applying 3-point smoothing to account for shaky hands"""
-		poly = self.roi.getInterpolatedPolygon(1, True);
-		return poly.getLength(True);
+		return self.measure()["path length"];
 
 	def getSinuosity(self):
 		"""return the sinuosity"""
-		return self.getPathLength()/self.getEuclidean() - 1;
+		return self.measure()["sinuosity"];
 
 	def __str__(self):
 		"""return string representation including roi's points"""
-		poly = self.roi.getFloatPolygon();
 		return ("Membrane " + str(self.positionNumber) + ", points = [\n" 
-				+ str([(x,y) for x,y in zip(poly.xpoints, poly.ypoints)]) + "\n]");
+				+ str(self.getPoints()) + "\n]");
 				
 class TimepointsMembranes:
-	"""class for holding all the drawn membranes for one timepoint"""
+	"""class for holding all the drawn membranes for one timepoint, indexed by position number"""
 
 	def __init__(self, input_image_title=None, time_point_s=0, init_membrane=None):
 		self.membranes = [];
 		self.input_image_title = input_image_title;
 		self.time_point_s = time_point_s;
+		self._index = {}; # position number -> index in self.membranes
 		if init_membrane is not None:
-			self.membranes.append(init_membrane);
+			self.addMembrane(init_membrane);
 
 	def setTimePoint(self, time_point_s):
 		"""set the time point in s for this set of membranes"""
@@ -119,17 +211,17 @@ class TimepointsMembranes:
 	def addMembrane(self, membrane):
 		"""add a membrane to the collection, or replace if necessary"""
 		new_number = membrane.positionNumber;
-		existing_numbers = [mem.positionNumber for mem in self.membranes]
-		if not new_number in existing_numbers:
+		if not new_number in self._index:
+			self._index[new_number] = len(self.membranes);
 			self.membranes.append(membrane);
 		else:
 			# overwrite - ask user if they really want to overwrite? 
-			self.membranes[existing_numbers.index(new_number)] = membrane;
+			self.membranes[self._index[new_number]] = membrane;
 
 	def getMembrane(self, number):
 		"""return a membrane corresponding to a given interface index defined in CB diagrams"""
-		if number in [membrane.positionNumber for membrane in self.membranes]:
-			return self.membranes[[membrane.positionNumber for membrane in self.membranes].index(number)];
+		if number in self._index:
+			return self.membranes[self._index[number]];
 		else:
 			return None;
 
@@ -138,36 +230,231 @@ class TimepointsMembranes:
 		return ("Time point " + str(self.time_point_s) + " s, membranes: \n " + 	
 				str([str(membrane) for membrane in self.membranes]));
 
+class MembraneStore:
+	"""all the drawn membranes of a session, indexed by (timepoint, position number) - timepoints are 
+	1-indexed frames of the analysis image. Membranes set are recorded in the journal, if given"""
+
+	def __init__(self, timepoints_membranes, journal=None):
+		self.timepoints_membranes = timepoints_membranes;
+		self.journal = journal;
+
+	def getMembrane(self, timepoint, number):
+		"""return the membrane at a timepoint with a given interface index, or None"""
+		return self.timepoints_membranes[timepoint - 1].getMembrane(number);
+
+	def setMembrane(self, timepoint, membrane):
+		"""add a membrane at a timepoint, replacing any with the same interface index"""
+		self.timepoints_membranes[timepoint - 1].addMembrane(membrane);
+		if self.journal is not None:
+			self.journal.recordMembrane(timepoint, membrane);
+
+	def getTimepointsMembranes(self):
+		"""return the list of TimepointsMembranes, as serialised to JSON"""
+		return self.timepoints_membranes;
+
+	def __len__(self):
+		return len(self.timepoints_membranes);
+
+class MembraneJournal:
+	"""append-only record of a drawing session - a header line describing the timepoints, then one JSON 
+	line per membrane committed - so that saving costs the same for every membrane and a crashed session 
+	can be resumed. Each time the journal is opened a segment line is written, with the time as its id, 
+	and the membranes recorded after it carry that id, so resumed sessions can be told apart. 
+	compact_journal rebuilds the Membranes JSON from it"""
+
+	def __init__(self, path, timepoints_membranes):
+		self.path = path;
+		new_journal = not os.path.isfile(path) or os.path.getsize(path) == 0;
+		torn_line = False;
+		if not new_journal:
+			f = open(path, 'rb');
+			try:
+				f.seek(-1, os.SEEK_END);
+				torn_line = f.read(1) != "\n";
+			finally:
+				f.close();
+		self.f = open(path, 'a');
+		if torn_line:
+			# end a record left incomplete by a crash, so that it can't swallow the next one
+			self.f.write("\n");
+		if new_journal:
+			self._write({"type" : "session", 
+						"input_image_title" : timepoints_membranes[0].input_image_title if timepoints_membranes else None, 
+						"time_points_s" : [tpm.time_point_s for tpm in timepoints_membranes]});
+		self.segment = datetime.now().isoformat();
+		self._write({"type" : "segment", "segment" : self.segment, "resumed" : not new_journal});
+
+	def _write(self, record):
+		self.f.write(json.dumps(record) + "\n");
+		self.f.flush();
+
+	def recordMembrane(self, timepoint, membrane):
+		"""append one membrane, at a 1-indexed timepoint"""
+		membrane.segment = self.segment;
+		record = encode_membrane(membrane);
+		record.update({"type" : "membrane", "timepoint" : timepoint});
+		self._write(record);
+
+	def close(self):
+		self.f.close();
+
+def read_journal(journal_path):
+	"""replay a journal, returning the list of TimepointsMembranes as at its last record. A partly 
+	written last line, as left by a crash, is ignored"""
+	timepoints_membranes = [];
+	f = open(journal_path, 'r');
+	try:
+		for line in f:
+			try:
+				record = json.loads(line);
+			except ValueError:
+				print("Ignoring incomplete journal record: " + line);
+				continue;
+			if record["type"] == "session":
+				timepoints_membranes = [TimepointsMembranes(input_image_title=record["input_image_title"], time_point_s=t) 
+										for t in record["time_points_s"]];
+			elif record["type"] == "membrane":
+				membrane = DrawnMembrane(positionNumber=record["position number"]);
+				membrane.segment = record.get("segment");
+				if record["roi"] is not None:
+					membrane.xpoints = array('f', [x for x, y in record["roi"]]);
+					membrane.ypoints = array('f', [y for x, y in record["roi"]]);
+					membrane.roi_type = record.get("roi type", Roi.FREELINE);
+				timepoints_membranes[record["timepoint"] - 1].addMembrane(membrane);
+	finally:
+		f.close();
+	return timepoints_membranes;
+
+def compact_journal(journal_path, json_path=None):
+	"""write the Membranes JSON (by default next to the journal, with the same name) from a journal"""
+	if json_path is None:
+		json_path = os.path.splitext(journal_path)[0] + ".json";
+	drawn_membranes = read_journal(journal_path);
+	f = open(json_path, 'w+');
+	try:
+		json.dump(drawn_membranes, f, default=encode_membrane);
+	finally:
+		f.close();
+	return json_path;
+
+def finish_journal(journal_path):
+	"""compact a journal to its Membranes JSON, and to a .mbin file where membrane_file is available. 
+	Returns the JSON path. A finished journal is no longer offered for resuming"""
+	json_path = compact_journal(journal_path);
+	if membrane_file is not None:
+		membrane_file.convert_json(json_path);
+	return json_path;
+
+def journal_timestamp(journal_path):
+	"""the timestamp in a journal's name, which every output of its session shares"""
+	return os.path.splitext(os.path.basename(journal_path))[0][len("Membranes "):];
+
+def find_resumable_journal(output_root, im_title):
+	"""most recent journal in output_root for this image that hasn't been compacted, or None"""
+	journals = [os.path.join(output_root, name) for name in os.listdir(output_root) 
+				if name.startswith("Membranes ") and name.endswith(JOURNAL_EXTENSION)];
+	for journal_path in sorted(journals, key=os.path.getmtime, reverse=True):
+		if os.path.isfile(os.path.splitext(journal_path)[0] + ".json"):
+			continue;
+		f = open(journal_path, 'r');
+		try:
+			header = json.loads(f.readline());
+		except ValueError:
+			continue;
+		finally:
+			f.close();
+		if header.get("input_image_title") == im_title:
+			return journal_path;
+	return None;
+
 class UpdateRoiImageListener(ImageListener):
-	"""class to support updating ROI from list upon change of frame"""
-	def __init__(self, membrane_timepoints_list):
+	"""class to support updating ROI from list upon change of frame. Only acts when the frame changes, 
+	only commits a ROI that differs from the stored membrane, and keeps the ROIs it shows so each is built 
+	once"""
+	frame_budget_ms = 1000.0 / 60; # one display frame
+
+	def __init__(self, membrane_store):
 		self.last_frame = 1;
 		self.current_membrane_index = 0;
-		self.membrane_timepoints_list = membrane_timepoints_list;
+		self.membrane_store = membrane_store;
+		self.roi_cache = {}; # (frame, membrane index) -> roi
+		self.resetLatencyStats();
 		print("UpdateRoiImageListener started");
 
 	def imageUpdated(self, imp):
-		print("image updated");
+		start = System.nanoTime();
+		self.n_events += 1;
 		frame = imp.getZ();
-		roi = imp.getRoi();
-		if roi is not None and not roi.isArea():
-			self.membrane_timepoints_list[self.last_frame - 1].addMembrane(DrawnMembrane(roi, self.current_membrane_index));
+		if frame == self.last_frame:
+			return;
+		self.commit(imp);
 		self.last_frame = frame;
-		this_frames_membrane = self.membrane_timepoints_list[frame - 1].getMembrane(self.current_membrane_index);
-		if this_frames_membrane is not None:
-			imp.setRoi(this_frames_membrane.getRoi());
+		self.showMembrane(imp);
+		elapsed_ms = (System.nanoTime() - start) / 1.0e6;
+		self.n_frame_changes += 1;
+		self.total_ms += elapsed_ms;
+		self.max_ms = max(self.max_ms, elapsed_ms);
+		if elapsed_ms > self.frame_budget_ms:
+			self.n_over_budget += 1;
+
+	def commit(self, imp):
+		"""store the image's ROI as the current membrane for the last frame shown, if it has changed"""
+		roi = imp.getRoi();
+		if roi is None or roi.isArea():
+			return;
+		stored = self.membrane_store.getMembrane(self.last_frame, self.current_membrane_index);
+		if stored is not None and stored.matchesRoi(roi):
+			return;
+		self.membrane_store.setMembrane(self.last_frame, DrawnMembrane(roi, self.current_membrane_index));
+		self.roi_cache[(self.last_frame, self.current_membrane_index)] = roi;
+		self.n_commits += 1;
+
+	def showMembrane(self, imp):
+		"""show the current membrane for the last frame shown, or no ROI if there isn't one"""
+		key = (self.last_frame, self.current_membrane_index);
+		roi = self.roi_cache.get(key);
+		if roi is None:
+			membrane = self.membrane_store.getMembrane(self.last_frame, self.current_membrane_index);
+			if membrane is not None:
+				roi = membrane.getRoi();
+				self.roi_cache[key] = roi;
+		if roi is not None:
+			imp.setRoi(roi);
 		else:
 			imp.killRoi();
 
+	def refresh(self, imp):
+		"""catch up with the frame shown without committing, e.g. after changing the membrane index"""
+		self.last_frame = imp.getZ();
+		self.showMembrane(imp);
+
+	def resetLatencyStats(self):
+		self.n_events = 0;
+		self.n_frame_changes = 0;
+		self.n_commits = 0;
+		self.n_over_budget = 0;
+		self.total_ms = 0.0;
+		self.max_ms = 0.0;
+
+	def getLatencyStats(self):
+		"""return counts of update events, frame changes handled, ROIs committed and frame changes that took 
+		longer than a display frame, with mean and max handling time in ms"""
+		return {"events" : self.n_events, 
+				"frame changes" : self.n_frame_changes, 
+				"commits" : self.n_commits, 
+				"over budget" : self.n_over_budget, 
+				"mean ms" : self.total_ms / self.n_frame_changes if self.n_frame_changes > 0 else 0.0, 
+				"max ms" : self.max_ms};
+
 	def imageOpened(self, imp):
 		print("UpdateRoiImageListener: image opened");
 			
 	def imageClosed(self, imp):
-		print("UpdateRoiImageListener: image closed");
+		print("UpdateRoiImageListener: image closed, latency " + str(self.getLatencyStats()));
 		imp.removeImageListener(self);
 
 	def getDrawnMembraneTimepointsList(self):
-		return self.membrane_timepoints_list;
+		return self.membrane_store.getTimepointsMembranes();
 
 	def setCurrentMembraneIndex(self, index):
 		self.current_membrane_index = index;
@@ -181,10 +468,17 @@ class UpdateRoiImageListener(ImageListener):
 def encode_membrane(obj):
 	"""specify encoding of drawn membranes to JSON"""
 	if isinstance(obj, DrawnMembrane):
-		if obj.roi is not None:
-			return {'position number': obj.positionNumber, 'roi' : [(x, y) for x, y in zip(obj.roi.getFloatPolygon().xpoints, obj.roi.getFloatPolygon().ypoints)]};
+		if obj.xpoints is not None:
+			encoded = {'position number': obj.positionNumber, 'roi' : obj.getPoints(), 'roi type' : obj.roi_type};
 		else:
-			return {'position number': obj.positionNumber, 'roi': None};
+			encoded = {'position number': obj.positionNumber, 'roi': None};
+		if obj.segment is not None:
+			encoded['segment'] = obj.segment;
+		return encoded;
+	elif isinstance(obj, TimepointsMembranes):
+		return {'membranes' : obj.membranes, 
+				'input_image_title' : obj.input_image_title, 
+				'time_point_s' : obj.time_point_s};
 	else:
 		try:
 			return obj.__dict__;
@@ -250,12 +544,32 @@ def main():
 	frames = [f + 1 for f in range(start_frame-1, end_frame, int(analysis_frame_step))];
 	print("frames = " + str(frames));
 	imp.killRoi();
-	analysis_imp = SubstackMaker().makeSubstack(imp, str(start_frame) + "-" + str(end_frame) + "-" + str(int(analysis_frame_step)));
+	analysis_imp = strided_substack_view(imp, frames);
+	# hide rather than close - closing would release the data the view reads from
 	imp.changes = False;
-	imp.close();
+	imp.hide();
 	analysis_imp.show();
 	drawn_membranes = [TimepointsMembranes(input_image_title=im_title, time_point_s=(t - 1) * acq_t_step) for t in frames];
-	membranes_listener = UpdateRoiImageListener(drawn_membranes);
+	journal_path = os.path.join(output_root, "Membranes " + timestamp + JOURNAL_EXTENSION);
+	resumable_path = find_resumable_journal(output_root, im_title);
+	if resumable_path is not None:
+		resume_dlg = GenericDialog("Resume?");
+		resume_dlg.addMessage("Found an unfinished session for this image:\n" + os.path.basename(resumable_path));
+		resume_dlg.enableYesNoCancel("Resume", "Start again");
+		resume_dlg.hideCancelButton();
+		resume_dlg.showDialog();
+		resumed_membranes = read_journal(resumable_path) if resume_dlg.wasOKed() else None;
+		if resumed_membranes is not None and len(resumed_membranes) == len(drawn_membranes):
+			timestamp = journal_timestamp(resumable_path);
+			journal_path = resumable_path;
+			drawn_membranes = resumed_membranes;
+		else:
+			if resumed_membranes is not None:
+				print("Can't resume - the unfinished session has a different number of timepoints");
+			# keep what was drawn, but don't offer it again
+			finish_journal(resumable_path);
+	journal = MembraneJournal(journal_path, drawn_membranes);
+	membranes_listener = UpdateRoiImageListener(MembraneStore(drawn_membranes, journal=journal));
 	analysis_imp.addImageListener(membranes_listener);
 
 	# now attach roi listener to store all 0th membranes after showing a waitforuserdialog to prompt continuation
@@ -267,16 +581,11 @@ def main():
 		membranes_listener.resetLastFrame();
 		membranes_listener.setCurrentMembraneIndex(membrane_idx);		
 		analysis_imp.setZ(1);
+		membranes_listener.refresh(analysis_imp);
 		continue_dlg = WaitForUserDialog("Continue?", "Click OK once all the " + str(membrane_idx) + "-index membranes have been drawn");
 		continue_dlg.show();
-		membranes_listener.imageUpdated(analysis_imp);
+		membranes_listener.commit(analysis_imp);
 		drawn_membranes = membranes_listener.getDrawnMembraneTimepointsList();
-		json_path = os.path.join(output_root, "Membranes " + timestamp + ".json");
-		f = open(json_path, 'w+');
-		try:
-			json.dump(drawn_membranes, f, default=encode_membrane);
-		finally:
-			f.close();
 		# save csv containing mebrane measurements for current membrane index
 		csv_path = os.path.join(output_root, ("Membrane measurements " + timestamp + ".csv"));
 		if membrane_idx==membrane_indices[0]:
@@ -296,18 +605,22 @@ def main():
 			for mems in drawn_membranes:
 				mem = mems.getMembrane(membrane_idx);
 				if mem is not None:
+					measurements = mem.measure();
 					writer.writerow([membrane_idx, 
 									mems.time_point_s,
-									mem.getPathLength() * cal.pixelWidth, 
-									mem.getEuclidean() * cal.pixelWidth, 
-									mem.getSinuosity()]);
+									measurements["path length"] * cal.pixelWidth, 
+									measurements["euclidean"] * cal.pixelWidth, 
+									measurements["sinuosity"]]);
 		finally:
 			f.close();
 		
+	journal.close();
+	finish_journal(journal_path);
 	settings.persistSettings();
 	settings.save_settings();
 	print("Finished getting all membranes with indices "  + str(membrane_indices));
 	analysis_imp.close();
+	imp.close();
 
 # It's best practice to create a function that contains the code that is executed when running the script.
 # This enables us to stop the script by just calling return.
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary container for drawn membranes, written next to the Membranes JSON of
+membrane_evolution_analysis.py. A JSON header holds the timepoints and an index of every
+membrane by (timepoint, position number); each membrane's coordinates follow as a block
+of x values then y values, so single membranes are read from a memory map without
+parsing the rest of the file. Works in CPython (2 or 3) and in Jython, where it maps the
+file with java.nio and returns java float[] arrays (float64 files are narrowed on reading,
+as ImageJ roi coordinates are float anyway) that PolygonRoi takes as is - copy this file to
+Fiji's jars/Lib to use it from scripts.
+
+Layout: 8 byte magic, little-endian uint32 version and header length, UTF-8 JSON header
+padded with spaces so the data starts on an 8 byte boundary, then the coordinate blocks
+(little-endian float32, or float64 when the source has values float32 can't hold).
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b'MEMBRANE'
+VERSION = 1
+BINARY_EXTENSION = '.mbin'
+JYTHON = sys.platform.startswith('java')
+TYPECODES = {'<f4': 'f', '<f8': 'd'}
+
+if JYTHON:
+	import jarray
+	from java.io import RandomAccessFile
+	from java.nio import ByteOrder
+	from java.nio.channels import FileChannel
+else:
+	import mmap
+
+def fits_float32(values):
+	# True if every value survives a round trip through float32
+	for v in values:
+		try:
+			if struct.unpack('<f', struct.pack('<f', v))[0] != v:
+				return False
+		except OverflowError:
+			return False
+	return True
+
+def write_membranes(path, timepoints, dtype=None):
+	# write timepoints in the Membranes JSON layout - a list of {'input_image_title',
+	# 'time_point_s', 'membranes': [{'position number', 'roi': [(x, y), ...] or None}]} -
+	# membranes may also carry a 'roi type', and the journal 'segment' they were drawn in, which
+	# isn't kept. dtype defaults to '<f4' if that is lossless
+	membranes = [(t, m) for t, tp in enumerate(timepoints) for m in tp['membranes']]
+	if dtype is None:
+		lossless = all(fits_float32([v for point in (m['roi'] or []) for v in point]) for t, m in membranes)
+		dtype = '<f4' if lossless else '<f8'
+	itemsize = struct.calcsize('<' + TYPECODES[dtype])
+	index = []
+	offset = 0
+	for t, m in membranes:
+		n_points = -1 if m['roi'] is None else len(m['roi'])
+		index.append([t, m['position number'], offset, n_points, m.get('roi type')])
+		offset += 2 * max(n_points, 0) * itemsize
+	header = {'dtype': dtype,
+			  'timepoints': [{'input_image_title': tp['input_image_title'], 'time_point_s': tp['time_point_s']}
+							 for tp in timepoints],
+			  'index': index}
+	text = json.dumps(header)
+	text += ' ' * (-(len(MAGIC) + 8 + len(text)) % 8)
+	f = open(path, 'wb')
+	try:
+		f.write(MAGIC)
+		f.write(struct.pack('<II', VERSION, len(text)))
+		f.write(text.encode('utf-8'))
+		for t, m in membranes:
+			if m['roi']:
+				n_points = len(m['roi'])
+				f.write(struct.pack('<%d%s' % (n_points, TYPECODES[dtype]), *[float(x) for x, y in m['roi']]))
+				f.write(struct.pack('<%d%s' % (n_points, TYPECODES[dtype]), *[float(y) for x, y in m['roi']]))
+	finally:
+		f.close()
+	return path
+
+class MembraneFile(object):
+	"""read-only, memory-mapped access to a file from write_membranes. Timepoints are 0-indexed, as in
+	the JSON list"""
+
+	def __init__(self, path):
+		self.path = path
+		f = open(path, 'rb')
+		try:
+			if f.read(len(MAGIC)) != MAGIC:
+				raise IOError(path + " is not a membrane file")
+			version, header_length = struct.unpack('<II', f.read(8))
+			if version > VERSION:
+				raise IOError(path + " is membrane file version " + str(version) + ", newer than this reader")
+			header = json.loads(f.read(header_length).decode('utf-8'))
+		finally:
+			f.close()
+		self.data_offset = len(MAGIC) + 8 + header_length
+		self.dtype = header['dtype']
+		self.itemsize = struct.calcsize('<' + TYPECODES[self.dtype])
+		self.timepoints = header['timepoints']
+		self._index = {}
+		self._positions = [[] for tp in self.timepoints]
+		for t, position, offset, n_points, roi_type in header['index']:
+			self._index[(t, position)] = (offset, n_points, roi_type)
+			self._positions[t].append(position)
+		self._map = None
+
+	def __len__(self):
+		return len(self.timepoints)
+
+	def positions(self, timepoint):
+		"""position numbers of the membranes at a timepoint, in the order they were stored"""
+		return list(self._positions[timepoint])
+
+	def roi_type(self, timepoint, position):
+		return self._index[(timepoint, position)][2]
+
+	def _mapped(self):
+		if self._map is None:
+			if JYTHON:
+				raf = RandomAccessFile(self.path, 'r')
+				try:
+					channel = raf.getChannel()
+					buf = channel.map(FileChannel.MapMode.READ_ONLY, self.data_offset,
+									  channel.size() - self.data_offset).order(ByteOrder.LITTLE_ENDIAN)
+				finally:
+					raf.close()
+				self._map = buf.asFloatBuffer() if self.itemsize == 4 else buf.asDoubleBuffer()
+			else:
+				f = open(self.path, 'rb')
+				try:
+					if os.path.getsize(self.path) > self.data_offset:
+						self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+					else:
+						self._map = b''
+				finally:
+					f.close()
+		return self._map
+
+	def _read(self, offset, n):
+		if JYTHON:
+			values = jarray.zeros(n, TYPECODES[self.dtype])
+			buf = self._mapped().duplicate()
+			buf.position(offset // self.itemsize)
+			buf.get(values)
+			if self.itemsize == 8:
+				# PolygonRoi has no double[] constructor
+				values = jarray.array(values, 'f')
+			return values
+		start = self.data_offset + offset
+		values = array(TYPECODES[self.dtype])
+		data = self._mapped()[start:start + n * self.itemsize]
+		if hasattr(values, 'frombytes'):
+			values.frombytes(data)
+		else:
+			values.fromstring(data)
+		if sys.byteorder == 'big':
+			values.byteswap()
+		return values
+
+	def get(self, timepoint, position):
+		"""(xs, ys) coordinate arrays of one membrane, or None if it was stored without an roi. Raises
+		KeyError if there is no such membrane"""
+		offset, n_points, roi_type = self._index[(timepoint, position)]
+		if n_points < 0:
+			return None
+		return self._read(offset, n_points), self._read(offset + n_points * self.itemsize, n_points)
+
+	def to_json_layout(self):
+		"""the whole file in the Membranes JSON layout, with the roi types where they were stored"""
+		timepoints = []
+		for t, tp in enumerate(self.timepoints):
+			membranes = []
+			for position in self._positions[t]:
+				xy = self.get(t, position)
+				membrane = {'position number': position,
+							'roi': None if xy is None else [(x, y) for x, y in zip(*xy)]}
+				if self.roi_type(t, position) is not None:
+					membrane['roi type'] = self.roi_type(t, position)
+				membranes.append(membrane)
+			timepoints.append({'input_image_title': tp['input_image_title'], 'time_point_s': tp['time_point_s'],
+							   'membranes': membranes})
+		return timepoints
+
+	def close(self):
+		if not JYTHON and isinstance(self._map, mmap.mmap):
+			self._map.close()
+		self._map = None
+
+def binary_path_for(json_path):
+	return os.path.splitext(json_path)[0] + BINARY_EXTENSION
+
+def convert_json(json_path, binary_path=None, verify=True):
+	# write the binary container for a Membranes JSON file and, with verify, check that
+	# reading it back gives exactly the JSON's contents
+	if binary_path is None:
+		binary_path = binary_path_for(json_path)
+	f = open(json_path, 'r')
+	try:
+		timepoints = json.loads(f.read())
+	finally:
+		f.close()
+	write_membranes(binary_path, timepoints)
+	if verify:
+		membrane_file = MembraneFile(binary_path)
+		try:
+			restored = membrane_file.to_json_layout()
+		finally:
+			membrane_file.close()
+		for tp in timepoints:
+			for m in tp['membranes']:
+				m.pop('segment', None)
+		if json.dumps(restored, sort_keys=True) != json.dumps(timepoints, sort_keys=True):
+			os.remove(binary_path)
+			raise ValueError("Conversion of " + json_path + " isn't lossless")
+	return binary_path
+
+def main():
+	parser = argparse.ArgumentParser(description="Convert Membranes JSON files to the binary membrane container")
+	parser.add_argument('json_files', nargs='+')
+	parser.add_argument('--no-verify', action='store_true', help="don't read back and compare")
+	args = parser.parse_args()
+	for json_path in args.json_files:
+		print("Wrote " + convert_json(json_path, verify=not args.no_verify))
+
+if __name__ == '__main__':
+	main()
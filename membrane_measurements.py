@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline recomputation of the "Membrane measurements" CSV of membrane_evolution_analysis.py
+from saved Membranes *.json (or .mbin) files, so measurements can be redone with a new
+calibration or new metrics without redrawing. Follows DrawnMembrane.measure(), which
+measures roi.getInterpolatedPolygon(1, True) as its path length, the straight line between
+its end points and length/euclidean - 1. As in ImageJ, freehand and traced membranes are
+smoothed first with a 3 point running average, and the path is then walked from its first
+point, each new point being where the path leaves a circle of radius 1 around the last one;
+what is left at the end (less than 1 pixel) is dropped. Membranes saved without an roi type
+are taken to be freehand lines, the session's drawing tool. Checked against ImageJ 1.51g
+(test_membrane_measurements.py); all membranes of a file are processed together in flat
+NumPy arrays, and files are processed in parallel.
+"""
+
+import argparse
+import glob
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import membrane_file as mf
+
+MEMBRANES_PREFIX = 'Membranes '
+MEASUREMENTS_PREFIX = 'Membrane measurements '
+SETTINGS_FILENAME = 'MembraneEvolutionAnalysisSettings.json'
+
+# ImageJ roi types (ij.gui.Roi) - getInterpolatedPolygon only smooths freehand and traced rois
+FREEROI, TRACED_ROI, LINE, POLYLINE, FREELINE = 3, 4, 5, 6, 7
+SMOOTHED_ROI_TYPES = (FREEROI, TRACED_ROI, FREELINE)
+DEFAULT_ROI_TYPE = FREELINE
+
+def load_membranes(path):
+	# (membrane index, time point, (n, 2) points, roi type) for every membrane with an roi,
+	# from a Membranes JSON file or its binary container
+	if os.path.splitext(path)[1] == mf.BINARY_EXTENSION:
+		membrane_file = mf.MembraneFile(path)
+		try:
+			timepoints = membrane_file.to_json_layout()
+		finally:
+			membrane_file.close()
+	else:
+		with open(path, 'r') as f:
+			timepoints = json.load(f)
+	return [(m['position number'], tp['time_point_s'], np.asarray(m['roi'], dtype=np.float64).reshape(-1, 2),
+			 m.get('roi type') or DEFAULT_ROI_TYPE)
+			for tp in timepoints for m in tp['membranes'] if m['roi'] is not None]
+
+def pack_paths(point_arrays):
+	# concatenate paths into flat x, y arrays, with each path's start index and point count
+	counts = np.array([len(p) for p in point_arrays], dtype=np.intp)
+	starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.intp)
+	points = np.concatenate(point_arrays) if len(point_arrays) else np.zeros((0, 2))
+	return points[:, 0], points[:, 1], starts, counts
+
+def smooth_paths(x, y, starts, counts, smoothed):
+	# ImageJ's 3 point running average for the paths where smoothed is True: points 1 to n-3 of
+	# each path in turn, each averaged with the already smoothed point before it (the last two
+	# points are left as they are). Paths are smoothed together, one point position at a time
+	xs, ys = x.copy(), y.copy()
+	counts = np.where(smoothed, counts, 0)
+	for k in range(1, int(counts.max(initial=0)) - 2):
+		i = starts[counts - 2 > k] + k
+		xs[i] = (xs[i - 1] + xs[i] + xs[i + 1]) / 3.0
+		ys[i] = (ys[i - 1] + ys[i] + ys[i + 1]) / 3.0
+	return xs, ys
+
+def interpolate_paths(x, y, starts, counts, interval=1.0):
+	# points along each path as ImageJ's getInterpolatedPolygon for lines: from the first point,
+	# each new point is where the path leaves the circle of radius interval around the last
+	# one, and the remainder (less than interval) at the end is dropped. Paths are walked
+	# together, each step either adding a point or moving on to the next segment.
+	# Returns flat x, y and the new counts
+	n = len(counts)
+	out_x, out_y, out_path = [x[starts]], [y[starts]], [np.arange(n)]
+	seg = starts.copy() # index of the start of the current segment
+	ax, ay = x[starts], y[starts] # position on the current segment
+	cx, cy = ax.copy(), ay.copy() # last point added
+	active = np.flatnonzero(counts >= 2)
+	last = starts + counts - 1
+	while len(active):
+		s = seg[active]
+		dx, dy = x[s + 1] - ax[active], y[s + 1] - ay[active]
+		fx, fy = ax[active] - cx[active], ay[active] - cy[active]
+		a = dx * dx + dy * dy
+		b = 2 * (fx * dx + fy * dy)
+		c = fx * fx + fy * fy - interval * interval
+		disc = b * b - 4 * a * c
+		with np.errstate(invalid='ignore', divide='ignore'):
+			t = (-b + np.sqrt(disc)) / (2 * a)
+		hit = (a > 0) & (disc >= 0) & (t >= 0) & (t <= 1)
+		h = active[hit]
+		ax[h] += t[hit] * dx[hit]
+		ay[h] += t[hit] * dy[hit]
+		cx[h], cy[h] = ax[h], ay[h]
+		out_x.append(ax[h].copy())
+		out_y.append(ay[h].copy())
+		out_path.append(h)
+		m = active[~hit]
+		seg[m] += 1
+		ax[m], ay[m] = x[seg[m]], y[seg[m]]
+		active = active[seg[active] < last[active]]
+	path = np.concatenate(out_path)
+	order = np.argsort(path, kind='stable')
+	return np.concatenate(out_x)[order], np.concatenate(out_y)[order], np.bincount(path, minlength=n)
+
+def path_lengths(x, y, counts):
+	starts = np.cumsum(counts) - counts
+	seg = np.hypot(np.diff(x), np.diff(y))
+	seg[(starts + counts - 1)[:-1]] = 0
+	arc = np.concatenate([[0.0], np.cumsum(seg)])
+	return arc[starts + counts - 1] - arc[starts]
+
+def measure_paths(point_arrays, roi_types=None, interval=1.0):
+	# path length, euclidean length (pixels) and sinuosity of each path, as
+	# DrawnMembrane.measure(); roi_types (default DEFAULT_ROI_TYPE) decide which paths are
+	# smoothed. Paths with fewer than 2 points give NaN
+	n = len(point_arrays)
+	if roi_types is None:
+		roi_types = [DEFAULT_ROI_TYPE] * n
+	result = {'path length': np.full(n, np.nan), 'euclidean': np.full(n, np.nan), 'sinuosity': np.full(n, np.nan)}
+	ok = np.array([len(p) >= 2 for p in point_arrays], dtype=bool)
+	if not ok.any():
+		return result
+	x, y, starts, counts = pack_paths([p for p, keep in zip(point_arrays, ok) if keep])
+	smoothed = np.isin(np.asarray(roi_types)[ok], SMOOTHED_ROI_TYPES)
+	x, y = smooth_paths(x, y, starts, counts, smoothed)
+	x, y, counts = interpolate_paths(x, y, starts, counts, interval=interval)
+	first = np.cumsum(counts) - counts
+	last = first + counts - 1
+	path_length = path_lengths(x, y, counts)
+	euclidean = np.hypot(x[last] - x[first], y[last] - y[first])
+	result['path length'][ok] = path_length
+	result['euclidean'][ok] = euclidean
+	with np.errstate(invalid='ignore', divide='ignore'):
+		result['sinuosity'][ok] = path_length / euclidean - 1
+	return result
+
+def read_membrane_indices(folder):
+	# membrane index order saved with the session's settings, if any
+	settings_path = os.path.join(folder, SETTINGS_FILENAME)
+	if not os.path.isfile(settings_path):
+		return None
+	with open(settings_path, 'r') as f:
+		return json.load(f).get('membrane_indices')
+
+def measurements_table(path, pixel_size=1.0, unit='pixel', time_unit='s', membrane_indices=None):
+	# the table membrane_evolution_analysis.main writes - rows grouped by membrane index (in
+	# the settings' order where known), then by time point
+	membranes = load_membranes(path)
+	measurements = measure_paths([points for index, t, points, roi_type in membranes],
+								 roi_types=[roi_type for index, t, points, roi_type in membranes])
+	DF = pd.DataFrame({'Membrane index': [index for index, t, points, roi_type in membranes],
+					   'Time point, ' + time_unit: [t for index, t, points, roi_type in membranes],
+					   'Membrane length, ' + unit: measurements['path length'] * pixel_size,
+					   'Euclidean length, ' + unit: measurements['euclidean'] * pixel_size,
+					   'Membrane sinuoisty': measurements['sinuosity']})
+	if membrane_indices is None:
+		membrane_indices = read_membrane_indices(os.path.dirname(os.path.abspath(path)))
+	order = list(membrane_indices or [])
+	order += [i for i in pd.unique(DF['Membrane index']) if i not in order]
+	rank = DF['Membrane index'].map({index: r for r, index in enumerate(order)})
+	return DF.iloc[np.lexsort((np.arange(len(DF)), rank.values))].reset_index(drop=True)
+
+def measurements_path_for(path):
+	folder, name = os.path.split(os.path.splitext(path)[0])
+	if name.startswith(MEMBRANES_PREFIX):
+		name = name[len(MEMBRANES_PREFIX):]
+	return os.path.join(folder, MEASUREMENTS_PREFIX + name + '.csv')
+
+def write_measurements(path, output_path=None, **kwargs):
+	if output_path is None:
+		output_path = measurements_path_for(path)
+	measurements_table(path, **kwargs).to_csv(output_path, index=False)
+	return output_path
+
+def find_membrane_files(paths):
+	# Membranes *.json files (or .mbin where there's no JSON) given directly or below folders
+	found = []
+	for path in paths:
+		if os.path.isdir(path):
+			candidates = sorted(glob.glob(os.path.join(path, '**', MEMBRANES_PREFIX + '*'), recursive=True))
+			jsons = [c for c in candidates if c.endswith('.json')]
+			binaries = [c for c in candidates if c.endswith(mf.BINARY_EXTENSION)
+						and os.path.splitext(c)[0] + '.json' not in jsons]
+			found.extend(sorted(jsons + binaries))
+		else:
+			found.append(path)
+	return found
+
+def process_file(args):
+	path, kwargs = args
+	try:
+		return write_measurements(path, **kwargs)
+	except Exception as e:
+		print("Measurement failed for " + path + ": " + str(e))
+		traceback.print_exc()
+		return None
+
+def main():
+	parser = argparse.ArgumentParser(description="Recompute membrane measurement CSVs from saved Membranes files")
+	parser.add_argument('paths', nargs='+', help="Membranes *.json/.mbin files, or folders to search for them")
+	parser.add_argument('-p', '--pixel-size', type=float, default=1.0, help="pixel width in calibrated units")
+	parser.add_argument('-u', '--unit', default='pixel', help="calibrated length unit")
+	parser.add_argument('-t', '--time-unit', default='s')
+	parser.add_argument('-j', '--processes', type=int, default=None,
+						help="number of worker processes (default: number of cores)")
+	args = parser.parse_args()
+	kwargs = {'pixel_size': args.pixel_size, 'unit': args.unit, 'time_unit': args.time_unit}
+	jobs = [(path, kwargs) for path in find_membrane_files(args.paths)]
+	with ProcessPoolExecutor(max_workers=args.processes) as executor:
+		written = list(executor.map(process_file, jobs))
+	print("Wrote %d of %d measurement files" % (sum(1 for w in written if w), len(jobs)))
+
+if __name__ == '__main__':
+	main()
@@ -3,25 +3,55 @@
 # Python implementation of previous code for generating quantitative comparisons of myosin 
 # intensity and morphological parameters against time. 
 
+# Folders and batch settings are script parameters, so Fiji asks for them when the script is run from 
+# the editor and takes them from the command line when headless, e.g.
+#   ImageJ --headless --run myosin_and_morphology.py "data_root='/data',output_root='/results',n_concurrent_files=4"
+# A manifest (see read_manifest) is looked for in data_root unless one is given.
+#@ File (label="Input folder", style="directory") data_root
+#@ File (label="Output folder", style="directory") output_root
+#@ File (label="Manifest (optional)", required=false) manifest
+#@ Integer (label="Files processed at once (with a manifest)", value=1, min=1) n_concurrent_files
+#@ Float (label="Cache size, GB (0 to disable)", value=20) cache_gb
+
 # python (jython) imports
-import os, sys, math
+import os, sys, math, csv, json, struct, hashlib, shutil, threading
 from datetime import datetime
 
 # java imports - aim to have UI components entirely swing, listeners and layouts awt
-from java.awt import Dimension, GridBagLayout, GridBagConstraints, GridLayout
+from java.awt import Dimension, GraphicsEnvironment, GridBagLayout, GridBagConstraints, GridLayout
+from java.io import RandomAccessFile
+from java.lang import Exception as JavaException, Runtime
+from java.lang.management import ManagementFactory, MemoryType
+from java.nio import ByteOrder
+from java.nio.channels import FileChannel
+from java.util.concurrent import Callable, Executors
 import javax.swing as swing
 import javax.swing.table.TableModel
 
 # imagej imports
-from ij import IJ, WindowManager, ImagePlus
-from ij.gui import Roi, PointRoi, PolygonRoi, GenericDialog, WaitForUserDialog
+from ij import CompositeImage, IJ, ImageListener, ImagePlus, ImageStack, Prefs
+from ij.gui import Roi, Overlay, PointRoi, PolygonRoi, GenericDialog, WaitForUserDialog
 from ij.io import OpenDialog, DirectoryChooser, FileSaver
 from ij.plugin import ChannelSplitter, Duplicator
-from ij.process import FloatPolygon, ImageConverter
-from ij.plugin.filter import GaussianBlur, ParticleAnalyzer
-from ij.plugin.frame import RoiManager
+from ij.process import AutoThresholder, FloatPolygon, ImageConverter, ImageProcessor
+from ij.plugin.filter import GaussianBlur, ParticleAnalyzer, RankFilters
 from loci.plugins import BF as bf
 
+EDGES_FILENAME = "basal_edges.i16";
+EDGES_MAGIC = "BASALEDG";
+CHANNEL_FILES = ["myosin_channel.tif", "membrane_channel.tif"];
+MASK_FILE = "myosin_mask.tif";
+PARAMETERS_FILE = "parameters.json";
+CACHE_FOLDER_NAME = ".myosin_and_morphology_cache";
+DEFAULT_CACHE_GB = 20;
+# everything preprocess_frame depends on - part of the cache key for the mask stage
+PREPROCESSING_PARAMETERS = {"blur_sigma_x" : 5.0, 
+							"blur_sigma_y" : 1.0, 
+							"blur_accuracy" : 0.02, 
+							"threshold" : "Otsu dark", 
+							"median_radius" : 1};
+MANIFEST_NAMES = ["myosin_and_morphology_manifest.json", "myosin_and_morphology_manifest.csv"];
+
 # searches for chosen file type within selected folder
 def filterByFileType(files, extension):
 	return [f for f in files if (os.path.splitext(f)[1] == extension)]
@@ -46,6 +76,106 @@ def pause_for_debug():
 	if gd.wasCanceled():
 		raise Exception("Run interupted");
 
+def preprocess_frame(ip, gb, rf):
+	"""blur, convert to mask (Otsu, dark background, threshold calculated for this frame) and despeckle 
+	one 8-bit frame in place, as the Gaussian blur loop, Convert to Mask and Despeckle steps did for the stack. 
+	Like Convert to Mask, foreground is 255 and background 0 whatever Prefs.blackBackground is - only the 
+	LUT depends on it, which preprocess_stack sets (checked in test_myosin_and_morphology.py)"""
+	gb.blurGaussian(ip, PREPROCESSING_PARAMETERS["blur_sigma_x"], PREPROCESSING_PARAMETERS["blur_sigma_y"], 
+					PREPROCESSING_PARAMETERS["blur_accuracy"]); # assymmetrical Gaussian
+	ip.setAutoThreshold(AutoThresholder.Method.Otsu, True, ImageProcessor.NO_LUT_UPDATE);
+	lower = int(ip.getMinThreshold());
+	ip.resetThreshold();
+	ip.threshold(lower - 1); # pixels >= lower -> 255, others -> 0
+	rf.rank(ip, PREPROCESSING_PARAMETERS["median_radius"], RankFilters.MEDIAN); # despeckle
+
+class FramePreprocessor(Callable):
+	"""preprocess a set of frames of a stack, with this worker's own filter instances"""
+
+	def __init__(self, stack, frame_indices):
+		self.stack = stack;
+		self.frame_indices = frame_indices;
+
+	def call(self):
+		gb = GaussianBlur();
+		rf = RankFilters();
+		for fridx in self.frame_indices:
+			preprocess_frame(self.stack.getProcessor(fridx + 1), gb, rf);
+		return len(self.frame_indices);
+
+def preprocess_stack(imp, n_threads=None):
+	"""run preprocess_frame over every frame of an 8-bit, single channel stack, spread over a pool of 
+	n_threads threads (default one per core). Frames are independent, so the result is the same as 
+	n_threads=1, which runs serially on the calling thread. As Convert to Mask, the mask gets an inverting 
+	LUT unless Prefs.blackBackground is set"""
+	stack = imp.getStack();
+	n_frames = stack.getSize();
+	if n_threads is None:
+		n_threads = Runtime.getRuntime().availableProcessors();
+	n_threads = max(1, min(n_threads, n_frames));
+	if n_threads == 1:
+		FramePreprocessor(stack, range(0, n_frames)).call();
+	else:
+		pool = Executors.newFixedThreadPool(n_threads);
+		try:
+			futures = pool.invokeAll([FramePreprocessor(stack, range(t, n_frames, n_threads)) 
+										for t in range(0, n_threads)]);
+			for future in futures:
+				future.get(); # raises if the worker failed
+		finally:
+			pool.shutdown();
+	if imp.isInvertedLut() != (not Prefs.blackBackground):
+		ip = imp.getProcessor();
+		ip.invertLut();
+		stack.setColorModel(ip.getColorModel());
+	imp.updateAndDraw();
+
+def fill_edge_gaps(edge, last_edge, width):
+	"""replace positions marked -1 (no edge found) in place, using the previous frame's edge at the left 
+	hand side, interpolation between good positions, and the last good position at the right hand side"""
+	# deal with pixels we've marked as missing an edge
+	xidx = -1;
+	while xidx < width - 1:
+		xidx = xidx + 1;
+		# if first position along edge is anomalous, take the value from the previous 
+		# frame's edge as a reasonable approximation
+		if (xidx==0) and (edge[xidx]==-1):
+			edge[xidx] = last_edge[xidx];
+			xidx = xidx + 1;
+		# if later positions are anomalous, interpolate between previous and next 
+		# successfully found edges
+		if (edge[xidx]==-1):
+			# last good edge position
+			x1 = xidx - 1;
+			y1 = edge[x1];
+			# find next good edge position
+			sub_xidx = xidx + 1;
+			wp = width - 1;
+			if (sub_xidx < wp):
+				while (edge[sub_xidx]==-1):
+					sub_xidx = sub_xidx + 1;
+					if (sub_xidx >= wp):
+						break;
+			# deal with case when no further good positions exisit - just continue
+			# edge using last good y position to the end of the image in x direction, 
+			# and terminate outer loop over x positions
+			if (sub_xidx >= wp):
+				for subsub_xidx in range(x1, width):
+					edge[subsub_xidx] = y1;
+				xidx = wp;
+			# deal with case when edge exists again after a while
+			else:
+				x2 = sub_xidx;
+				y2 = edge[x2];
+				# interpolate between last good position and next good position
+				for subsub_xidx in range((x1 + 1), x2):
+					edge[subsub_xidx] = round((float(subsub_xidx - x1)/
+													(x2 - x1)) * (y2 - y1) +  y1);
+				# get outer loop to skip over section we've just dealt with by updating
+				# xidx accordingly
+				xidx = x2 - 1;
+	return edge;
+
 def find_basal_edges(imp, search_range=10):
 	edges = [];
 	for fridx in range(0, imp.getNFrames()):
@@ -76,61 +206,601 @@ def find_basal_edges(imp, search_range=10):
 				if (pix_val != 0):
 					edge[xidx] = yidx;
 			
-			# deal with pixels we've marked as missing an edge
-			xidx = -1;
-			while xidx < imp.getWidth() - 1:
-				xidx = xidx + 1;
-				# if first position along edge is anomalous, take the value from the previous 
-				# frame's edge as a reasonable approximation
-				if (xidx==0) and (edge[xidx]==-1):
-					edge[xidx] = edges[fridx-1][xidx];
-					xidx = xidx + 1;
-				# if later positions are anomalous, interpolate between previous and next 
-				# successfully found edges
-				if (edge[xidx]==-1):
-					# last good edge position
-					x1 = xidx - 1;
-					y1 = edge[x1];
-					# find next good edge position
-					sub_xidx = xidx + 1;
-					wp = imp.getWidth() - 1;
-					if (sub_xidx < wp):
-						while (edge[sub_xidx]==-1):
-							sub_xidx = sub_xidx + 1;
-							if (sub_xidx >= wp):
-								break;
-					# deal with case when no further good positions exisit - just continue
-					# edge using last good y position to the end of the image in x direction, 
-					# and terminate outer loop over x positions
-					if (sub_xidx >= wp):
-						for subsub_xidx in range(x1, imp.getWidth()):
-							edge[subsub_xidx] = y1;
-						xidx = wp;
-					# deal with case when edge exists again after a while
-					else:
-						x2 = sub_xidx;
-						y2 = edge[x2];
-						# interpolate between last good position and next good position
-						for subsub_xidx in range((x1 + 1), x2):
-							edge[subsub_xidx] = round((float(subsub_xidx - x1)/
-															(x2 - x1)) * (y2 - y1) +  y1);
-						# get outer loop to skip over section we've just dealt with by updating
-						# xidx accordingly
-						xidx = x2 - 1;
+			fill_edge_gaps(edge, edges[fridx-1], imp.getWidth());
 		edges.append(edge);	
 	return edges;
 
-def main():
-	#print (sys.version_info) # debug
-	#print(sys.path) # debug
-	data_root = r'C:\Users\dougk\Desktop\test'; # debug
-	output_root = r'C:\Users\dougk\Desktop\test'; #debug
-	#default_directory = r'C:\\Users\\Doug\\Desktop\\test';
-	#data_root, output_root = file_location_chooser(default_directory);
+def find_basal_edges_bulk(imp, search_range=10):
+	"""as find_basal_edges, but fetching each frame's pixel array once with getPixels() and scanning 
+	columns in the flat array rather than calling imp.getPixel for every pixel. Pixels outside the image 
+	read as 0, as for getPixel"""
+	w = imp.getWidth();
+	h = imp.getHeight();
+	stack = imp.getStack();
+	edges = [];
+	for fridx in range(0, imp.getNFrames()):
+		print("Examining frame " + str(fridx) + "...");
+		# only zero/non-zero matters, so signed Java bytes are fine
+		pix = stack.getPixels(fridx + 1);
+		edge = w * [-1];
+		if (fridx == 0):
+			for xidx in range(0, w):
+				yidx = h - 1;
+				while (yidx >= 0) and (pix[yidx * w + xidx] == 0):
+					yidx = yidx - 1;
+				edge[xidx] = yidx;
+		else:
+			last_edge = edges[fridx-1];
+			for xidx in range(0, w):
+				yidx = int(last_edge[xidx] + search_range);
+				pix_val = pix[yidx * w + xidx] if (0 <= yidx < h) else 0;
+				while (pix_val==0) and (yidx > (last_edge[xidx] - search_range)):
+					yidx = yidx - 1;
+					pix_val = pix[yidx * w + xidx] if (0 <= yidx < h) else 0;
+				if (pix_val != 0):
+					edge[xidx] = yidx;
+			fill_edge_gaps(edge, last_edge, w);
+		edges.append(edge);
+	return edges;
+
+def save_basal_edges(path, edges, metadata):
+	"""save edges (one list of y pixel indices per frame) as a compact binary file: 8 byte magic, 
+	little-endian uint32 header length, JSON header (metadata plus shape and dtype) space-padded so that 
+	the data starts on a 16 byte boundary, then frames x width little-endian int16. basal_edges.load_edges 
+	reads it in CPython"""
+	width = len(edges[0]) if len(edges) > 0 else 0;
+	header = dict(metadata);
+	header.update({"shape" : [len(edges), width], "dtype" : "<i2", "y_origin" : "top row = 0"});
+	text = json.dumps(header);
+	text = text + " " * ((-(len(EDGES_MAGIC) + 4 + len(text))) % 16);
+	f = open(path, 'wb');
+	try:
+		f.write(EDGES_MAGIC);
+		f.write(struct.pack("<I", len(text)));
+		f.write(text);
+		row_format = "<%dh" % width;
+		for edge in edges:
+			f.write(struct.pack(row_format, *[int(y) for y in edge]));
+	finally:
+		f.close();
+
+def map_basal_edges(path):
+	"""memory-map a file written by save_basal_edges, returning the header dictionary and a read-only 
+	ShortBuffer of the frames x width values"""
+	f = open(path, 'rb');
+	try:
+		if f.read(len(EDGES_MAGIC)) != EDGES_MAGIC:
+			raise IOError(path + " is not a basal edges file");
+		header_length = struct.unpack("<I", f.read(4))[0];
+		metadata = json.loads(f.read(header_length));
+	finally:
+		f.close();
+	offset = len(EDGES_MAGIC) + 4 + header_length;
+	frames, width = metadata["shape"];
+	raf = RandomAccessFile(path, "r");
+	try:
+		buf = raf.getChannel().map(FileChannel.MapMode.READ_ONLY, offset, 2 * frames * width);
+	finally:
+		raf.close();
+	return metadata, buf.order(ByteOrder.LITTLE_ENDIAN).asShortBuffer();
+
+class EdgeOverlayListener(ImageListener):
+	"""shows the basal edge of the current frame of imp as an overlay, building the polyline only when the 
+	frame changes rather than holding one ROI per frame. Image listeners hear about every image, so events 
+	from other images are ignored"""
+	def __init__(self, imp, edge_buffer, width):
+		self.imp = imp;
+		self.edge_buffer = edge_buffer;
+		self.width = width;
+		self.xs = [float(x) for x in range(1, width+1)];
+		self.frame = None;
+
+	def imageUpdated(self, imp):
+		if imp is not self.imp:
+			return;
+		frame = imp.getT();
+		if frame == self.frame:
+			return;
+		self.frame = frame;
+		start = (frame - 1) * self.width;
+		ys = [float(self.edge_buffer.get(start + x)) for x in range(0, self.width)];
+		imp.setOverlay(Overlay(PolygonRoi(self.xs, ys, Roi.POLYLINE)));
+
+	def imageOpened(self, imp):
+		pass;
+
+	def imageClosed(self, imp):
+		if imp is self.imp:
+			ImagePlus.removeImageListener(self);
+
+def ask_file_parameters(imp):
+	"""interactively choose rotation and the period of interest for an open image. Returns the (possibly 
+	rotated) image and a parameters dictionary in the same form as a manifest entry"""
+	# rotation step - since using multiples of 90, TransformJ's Turn is more efficient
+	IJ.run("Enhance Contrast", "saturated=0.35");
+	angleZ = 1;
+	while ((angleZ % 90) > 0):
+		gd = GenericDialog("Rotate?");
+		gd.addMessage("Define rotation angle - increments of 90. Apical at top");
+		gd.addNumericField("Rotation angle", 0, 0);
+		gd.showDialog();
+		angleZ = int(gd.getNextNumber());
+		
+	if (angleZ > 1):
+		rotated = rotate_imp(imp, angleZ);
+		imp.close();
+		imp = rotated;
+		imp.show();
+
+	# trim time series
+	IJ.run("Enhance Contrast", "saturated=0.35");
+	imp.setDisplayMode(IJ.COLOR);
+	WaitForUserDialog("Scroll to the first frame of the period of interest and click OK").show();
+	start_frame = imp.getT();
+	WaitForUserDialog("Scroll to the last frame of the period of interest and click OK").show();
+	end_frame = imp.getT();
+	params = default_file_parameters(imp);
+	params.update({"rotation" : angleZ if angleZ > 1 else 0, 
+					"rotated_with" : "TransformJ Turn", 
+					"start_frame" : start_frame, 
+					"end_frame" : end_frame});
+	return imp, params;
+
+def default_file_parameters(imp=None):
+	"""parameters used for anything not given in a manifest entry: no rotation, all frames, membrane in 
+	channel 1 and myosin in channel 2. Without an image end_frame is None, meaning the last frame"""
+	return {"rotation" : 0, 
+			"rotated_with" : "TransformJ Turn", 
+			"start_frame" : 1, 
+			"end_frame" : None if imp is None else imp.getNFrames(), 
+			"membrane_channel" : 1, 
+			"myosin_channel" : 2};
+
+def stage_parameters(params):
+	"""the parameters that determine the saved channels, for the cache key"""
+	return [params["rotated_with"]] + [None if params[key] is None else int(params[key]) 
+										for key in ["rotation", "start_frame", "end_frame", "myosin_channel", 
+													"membrane_channel"]];
+
+class StageCache(object):
+	"""content-addressed store of stage outputs, so that reruns with unchanged inputs and parameters load 
+	them rather than recomputing. Each entry is a folder of files named by a hash of the stage, the input 
+	file's content hash and the stage's parameters. Entries are never changed once written; evict removes 
+	least recently used entries once the total size exceeds max_bytes, and must only be called when no 
+	file is being processed, since entries are read without the lock"""
+
+	def __init__(self, root, max_bytes):
+		self.root = root;
+		self.max_bytes = max_bytes;
+		self.lock = threading.Lock();
+		if not os.path.isdir(root):
+			os.makedirs(root);
+		self.hash_index_path = os.path.join(root, "file_hashes.json");
+		self.hash_index = {};
+		if os.path.isfile(self.hash_index_path):
+			f = open(self.hash_index_path, 'r');
+			try:
+				self.hash_index = json.loads(f.read());
+			finally:
+				f.close();
+
+	def file_hash(self, path):
+		"""SHA-1 of a file's contents, remembered against its size and modification time so that unchanged 
+		files are only read once"""
+		path = os.path.abspath(path);
+		st = os.stat(path);
+		stamp = [st.st_size, st.st_mtime];
+		with self.lock:
+			entry = self.hash_index.get(path);
+		if entry is not None and entry["stamp"] == stamp:
+			return entry["sha1"];
+		digest = hashlib.sha1();
+		f = open(path, 'rb');
+		try:
+			chunk = f.read(1 << 22);
+			while chunk:
+				digest.update(chunk);
+				chunk = f.read(1 << 22);
+		finally:
+			f.close();
+		with self.lock:
+			self.hash_index[path] = {"stamp" : stamp, "sha1" : digest.hexdigest()};
+			f = open(self.hash_index_path, 'w');
+			try:
+				f.write(json.dumps(self.hash_index));
+			finally:
+				f.close();
+		return digest.hexdigest();
+
+	def key(self, stage, *parts):
+		return stage + "-" + hashlib.sha1(json.dumps([stage] + list(parts), sort_keys=True)).hexdigest();
+
+	def stage_keys(self, input_hash, params):
+		"""keys of the channels and mask entries for an input file and its parameters"""
+		channels_key = self.key("channels", input_hash, stage_parameters(params));
+		return channels_key, self.key("mask", channels_key, PREPROCESSING_PARAMETERS);
+
+	def get(self, key, names):
+		"""paths of the named files of a cache entry, or None if it isn't complete"""
+		entry = os.path.join(self.root, key);
+		paths = [os.path.join(entry, name) for name in names];
+		with self.lock:
+			if not all([os.path.isfile(p) for p in paths]):
+				return None;
+			os.utime(entry, None); # mark as recently used
+		return paths;
+
+	def put(self, key, paths):
+		"""copy files into a cache entry. If another job wrote the same entry meanwhile, it is kept - keys 
+		cover everything the contents depend on - so entries being read are never replaced"""
+		entry = os.path.join(self.root, key);
+		temp = entry + ".tmp-" + str(threading.current_thread().ident);
+		if not os.path.isdir(temp):
+			os.makedirs(temp);
+		for path in paths:
+			shutil.copyfile(path, os.path.join(temp, os.path.basename(path)));
+		with self.lock:
+			if os.path.isdir(entry):
+				shutil.rmtree(temp);
+			else:
+				os.rename(temp, entry);
+
+	def evict(self):
+		with self.lock:
+			entries = [];
+			total = 0;
+			for name in os.listdir(self.root):
+				entry = os.path.join(self.root, name);
+				if not os.path.isdir(entry) or ".tmp-" in name:
+					continue;
+				size = sum([os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)]);
+				entries.append((os.path.getmtime(entry), name, size));
+				total = total + size;
+			for mtime, name, size in sorted(entries):
+				if total <= self.max_bytes:
+					break;
+				shutil.rmtree(os.path.join(self.root, name));
+				total = total - size;
+
+def rotate_imp(imp, angle):
+	"""turn all planes of an image by a multiple of 90 degrees about the z-axis without any UI, keeping 
+	hyperstack dimensions. Uses ImageScience's Turn, which the TransformJ Turn command runs, so angles mean 
+	what TransformJ Turn's z-angle means, in manifests as in the interactive dialog"""
+	angle = int(angle) % 360;
+	if (angle % 90) > 0:
+		raise ValueError("Rotation angle must be a multiple of 90, not " + str(angle));
+	if angle == 0:
+		return imp;
+	try:
+		from imagescience.image import Image as ImageScienceImage;
+		from imagescience.transform import Turn;
+	except ImportError:
+		raise ImportError("Rotation needs TransformJ - enable the ImageScience update site in Fiji");
+	rotated = Turn().run(ImageScienceImage.wrap(imp), angle, 0, 0).imageplus();
+	rotated.setTitle(imp.getTitle());
+	rotated.setDimensions(imp.getNChannels(), imp.getNSlices(), imp.getNFrames());
+	cal = imp.getCalibration().copy();
+	if (angle % 180) == 90:
+		cal.pixelWidth, cal.pixelHeight = cal.pixelHeight, cal.pixelWidth;
+	rotated.setCalibration(cal);
+	if imp.isHyperStack():
+		rotated.setOpenAsHyperStack(True);
+	if imp.isComposite():
+		rotated = CompositeImage(rotated, imp.getCompositeMode());
+	return rotated;
+
+def substack_view(imp, channels, start_frame, end_frame, title=None):
+	"""stack of the given (1-based) channels, all slices, and frames start_frame..end_frame of imp, whose 
+	planes share pixel arrays with imp rather than copying them - anything that modifies pixels in place 
+	must work on a copy"""
+	stack = imp.getStack();
+	view = ImageStack(imp.getWidth(), imp.getHeight());
+	for t in range(start_frame, end_frame + 1):
+		for z in range(1, imp.getNSlices() + 1):
+			for c in channels:
+				idx = imp.getStackIndex(c, z, t);
+				view.addSlice(stack.getSliceLabel(idx), stack.getPixels(idx));
+	view_imp = ImagePlus(imp.getTitle() if title is None else title, view);
+	view_imp.setDimensions(len(channels), imp.getNSlices(), end_frame - start_frame + 1);
+	view_imp.setCalibration(imp.getCalibration());
+	if len(channels) > 1:
+		view_imp.setOpenAsHyperStack(True);
+		if imp.isComposite():
+			view_imp = CompositeImage(view_imp, imp.getCompositeMode());
+	return view_imp;
+
+def heap_pools():
+	return [pool for pool in ManagementFactory.getMemoryPoolMXBeans() if pool.getType() == MemoryType.HEAP];
+
+def reset_peak_memory():
+	for pool in heap_pools():
+		pool.resetPeakUsage();
+
+def peak_memory_mb():
+	"""peak heap use since reset_peak_memory, summed over pools (so a slight overestimate). When several 
+	files are processed concurrently this covers all of them"""
+	return sum([pool.getPeakUsage().getUsed() for pool in heap_pools()]) / float(1024 * 1024);
+
+def release(*imps):
+	"""free the pixels of images that are no longer needed. close() alone doesn't without a window, and 
+	flushing one image leaves the planes that views of it still reference"""
+	for imp in imps:
+		if imp is not None:
+			imp.flush();
+
+def extract_channels(imp, params, use_views=True):
+	"""trimmed image and myosin and membrane channel images. With use_views they share imp's pixel arrays, 
+	otherwise they are copies"""
+	start_frame = int(params["start_frame"]);
+	end_frame = int(params["end_frame"]);
+	if use_views:
+		trim_imp = substack_view(imp, range(1, imp.getNChannels() + 1), start_frame, end_frame);
+		myo_imp = substack_view(imp, [int(params["myosin_channel"])], start_frame, end_frame, "myosin");
+		mem_imp = substack_view(imp, [int(params["membrane_channel"])], start_frame, end_frame, "membrane");
+		return trim_imp, myo_imp, mem_imp;
+	trim_imp = Duplicator().run(imp, 1, imp.getNChannels(), 1, imp.getNSlices(), start_frame, end_frame);
+	dup_imp = Duplicator().run(trim_imp);
+	dup_imps = ChannelSplitter().split(dup_imp);
+	return trim_imp, dup_imps[int(params["myosin_channel"]) - 1], dup_imps[int(params["membrane_channel"]) - 1];
+
+def save_parameters(path, params):
+	f = open(path, 'w');
+	try:
+		f.write(json.dumps(params));
+	finally:
+		f.close();
+
+def load_parameters(path):
+	f = open(path, 'r');
+	try:
+		return json.loads(f.read());
+	finally:
+		f.close();
+
+def process_file(imp, output_subfolder, params, show=True, n_threads=None, use_views=True, cache=None, 
+					input_hash=None):
+	"""trim, split channels, save, preprocess the myosin channel and find basal edges for one image, 
+	according to params (see default_file_parameters). Edges are saved to EDGES_FILENAME in 
+	output_subfolder; with show=False nothing is displayed. With use_views, trimming and channel selection 
+	share imp's pixel arrays and only the myosin channel, which is modified, is copied. With a StageCache 
+	and the input file's hash, saved channels and the preprocessed mask are loaded from the cache when 
+	their parameters are unchanged - imp may then be None if the channels are cached and show is False"""
+	reset_peak_memory();
+	channel_files = mask_files = None;
+	if cache is not None:
+		channels_key, mask_key = cache.stage_keys(input_hash, params);
+		channel_files = cache.get(channels_key, CHANNEL_FILES + [PARAMETERS_FILE]);
+		mask_files = cache.get(mask_key, [MASK_FILE]);
+	if channel_files is not None:
+		# end_frame as resolved when the entry was made
+		params = dict(params, end_frame=load_parameters(channel_files[-1])["end_frame"]);
+	elif params["end_frame"] is None:
+		params = dict(params, end_frame=imp.getNFrames());
+
+	trim_imp = myo_imp = mem_imp = None;
+	if channel_files is None:
+		trim_imp, myo_imp, mem_imp = extract_channels(imp, params, use_views=use_views);
+	elif show:
+		trim_imp = substack_view(imp, range(1, imp.getNChannels() + 1), int(params["start_frame"]), 
+									int(params["end_frame"]));
+	# frames outside the period of interest are released here - the views only reference trimmed planes
+	if imp is not None:
+		imp.close();
+		release(imp);
+	imp = None;
+	if show:
+		trim_imp.show();
+
+	# create images to process and find bounds for
+	channel_paths = [os.path.join(output_subfolder, name) for name in CHANNEL_FILES];
+	if channel_files is None:
+		FileSaver(myo_imp).saveAsTiffStack(channel_paths[0]);
+		FileSaver(mem_imp).saveAsTiffStack(channel_paths[1]);
+		mem_imp.hide();
+		if cache is not None:
+			params_path = os.path.join(output_subfolder, PARAMETERS_FILE);
+			save_parameters(params_path, params);
+			cache.put(channels_key, channel_paths + [params_path]);
+	else:
+		for cached, path in zip(channel_files, channel_paths):
+			shutil.copyfile(cached, path);
+
+	# set basal bounds
+	mask_path = os.path.join(output_subfolder, MASK_FILE);
+	if mask_files is not None:
+		shutil.copyfile(mask_files[0], mask_path);
+		myo_imp = IJ.openImage(mask_path);
+		if show:
+			myo_imp.show();
+	else:
+		if myo_imp is None:
+			# a private copy, so no need to protect shared planes
+			myo_imp = IJ.openImage(channel_paths[0]);
+		elif use_views and myo_imp.getBitDepth() == 8:
+			# preprocessing is in place, so copy rather than alter the planes shared with trim_imp
+			myo_imp = myo_imp.duplicate();
+		if show:
+			myo_imp.show();
+		# for other bit depths this makes new 8-bit planes, leaving the shared ones untouched
+		ImageConverter(myo_imp).convertToGray8();
+		preprocess_stack(myo_imp, n_threads=n_threads);
+		FileSaver(myo_imp).saveAsTiffStack(mask_path);
+		if cache is not None:
+			cache.put(mask_key, [mask_path]);
+
+	# assume that first frame is good quality image...
+	basal_edges = find_basal_edges_bulk(myo_imp);
+	#myo_imp.hide()
+	print("Peak heap use for " + output_subfolder + ": %.0f MB (max %.0f MB)" % (peak_memory_mb(), 
+																		Runtime.getRuntime().maxMemory() / float(1024 * 1024)));
+
+	cal = myo_imp.getCalibration();
+	metadata = {"source" : params.get("file", os.path.basename(output_subfolder)), 
+				"pixel_width" : cal.pixelWidth, 
+				"pixel_height" : cal.pixelHeight, 
+				"unit" : cal.getUnit(), 
+				"frame_interval" : cal.frameInterval, 
+				"time_unit" : cal.getTimeUnit()};
+	for key in ["rotation", "start_frame", "end_frame", "myosin_channel", "membrane_channel"]:
+		metadata[key] = int(params[key]);
+	edges_path = os.path.join(output_subfolder, EDGES_FILENAME);
+	save_basal_edges(edges_path, basal_edges, metadata);
+	if not show:
+		# nothing is displayed, so drop every plane of this file before the next one is opened
+		release(trim_imp, myo_imp, mem_imp);
+		return basal_edges;
+
+	# draw the edge for the frame being viewed, read from the saved file
+	metadata, edge_buffer = map_basal_edges(edges_path);
+	trim_imp.show();
+	trim_imp.setPosition(int(params["myosin_channel"]), 1, 1);
+	IJ.run(trim_imp, "Enhance Contrast", "saturated=0.35");
+	ImagePlus.addImageListener(EdgeOverlayListener(trim_imp, edge_buffer, metadata["shape"][1]));
+	trim_imp.updateAndDraw();
+	#myo_imp.show()
+
+	# after getting rid of incorrectly segmented non-basal myosin, 
+	# perform previous edge search to identify the bottom AND TOP edges of the bright band
+	# then can draw these on the masks, fill holes and have a mask that effectively collects
+	# all basal myosin, as well as a line that delineates the end of the cell
+	return basal_edges;
+
+def parse_manifest_entry(entry):
+	"""whole-number manifest values as ints, accepting the "90.0" or 1.0 that spreadsheets and JSON writers 
+	often give for them"""
+	entry = dict(entry);
+	for key in ["rotation", "start_frame", "end_frame", "myosin_channel", "membrane_channel"]:
+		if entry.get(key) is None:
+			continue;
+		value = float(entry[key]);
+		if value != int(value):
+			raise ValueError("Manifest " + key + " must be a whole number, not " + str(entry[key]));
+		entry[key] = int(value);
+	return entry;
+
+def read_manifest(manifest_path):
+	"""read per-file parameters from a JSON or CSV sidecar manifest, returning a dictionary keyed by file 
+	name. JSON may be an object keyed by file name or a list of objects with a "file" entry; CSV needs a 
+	"file" column. Other entries/columns are rotation, start_frame, end_frame, myosin_channel and 
+	membrane_channel, read by parse_manifest_entry; blank CSV cells fall back to default_file_parameters. 
+	rotation is TransformJ Turn's z-angle, as rotate_imp"""
+	f = open(manifest_path, 'r');
+	try:
+		if os.path.splitext(manifest_path)[1].lower() == '.csv':
+			entries = [dict((k, v) for k, v in row.items() if v not in (None, '')) for row in csv.DictReader(f)];
+		else:
+			entries = json.loads(f.read());
+	finally:
+		f.close();
+	if isinstance(entries, dict):
+		return dict((file_name, parse_manifest_entry(entry)) for file_name, entry in entries.items());
+	return dict((entry["file"], parse_manifest_entry(entry)) for entry in entries);
+
+def find_manifest(data_root):
+	for manifest_name in MANIFEST_NAMES:
+		manifest_path = os.path.join(data_root, manifest_name);
+		if os.path.isfile(manifest_path):
+			return manifest_path;
+	return None;
+
+class HeadlessFileJob(Callable):
+	"""process one manifest entry without any UI"""
+
+	def __init__(self, data_root, output_path, file_path, entry, n_threads, cache=None):
+		self.data_root = data_root;
+		self.output_path = output_path;
+		self.file_path = file_path;
+		self.entry = entry;
+		self.n_threads = n_threads;
+		self.cache = cache;
+
+	def call(self):
+		output_subfolder = os.path.join(self.output_path, os.path.splitext(self.file_path)[0]);
+		print(output_subfolder);
+		os.makedirs(output_subfolder);
+		input_path = os.path.join(self.data_root, self.file_path);
+		params = default_file_parameters();
+		params.update(self.entry);
+		params["file"] = self.file_path;
+		input_hash = None;
+		channels_cached = False;
+		if self.cache is not None:
+			input_hash = self.cache.file_hash(input_path);
+			channels_key = self.cache.stage_keys(input_hash, params)[0];
+			channels_cached = self.cache.get(channels_key, CHANNEL_FILES + [PARAMETERS_FILE]) is not None;
+		if channels_cached:
+			print("Using cached channels for " + self.file_path);
+			imp = None;
+		else:
+			imp = rotate_imp(bf.openImagePlus(input_path)[0], params["rotation"]);
+		try:
+			process_file(imp, output_subfolder, params, show=False, n_threads=self.n_threads, 
+							cache=self.cache, input_hash=input_hash);
+		finally:
+			# also when processing failed part way through
+			release(imp);
+		return self.file_path;
+
+def run_headless(data_root, output_path, manifest_path, n_concurrent_files=1, cache=None):
+	"""process every tif in data_root listed in the manifest without any dialogs, n_concurrent_files at 
+	a time. Files missing from the manifest are skipped"""
+	manifest = read_manifest(manifest_path);
+	file_paths = filterByFileType(os.listdir(data_root), '.tif');
+	for file_path in file_paths:
+		if file_path not in manifest:
+			print("Skipping " + file_path + ": not in manifest " + manifest_path);
+	jobs_files = [fp for fp in file_paths if fp in manifest];
+	n_concurrent_files = max(1, min(n_concurrent_files, len(jobs_files)));
+	n_threads = max(1, Runtime.getRuntime().availableProcessors() / n_concurrent_files);
+	jobs = [HeadlessFileJob(data_root, output_path, fp, manifest[fp], n_threads, cache=cache) for fp in jobs_files];
+	# a file that fails is reported and skipped, whether files are processed one at a time or concurrently. 
+	# The cache is only evicted while no job is reading it - between files, or after the whole pool
+	failed = [];
+	if n_concurrent_files == 1:
+		for job in jobs:
+			try:
+				job.call();
+			except (Exception, JavaException) as e:
+				print("Failed to process " + job.file_path + ": " + str(e));
+				failed.append(job.file_path);
+			if cache is not None:
+				cache.evict();
+	else:
+		pool = Executors.newFixedThreadPool(n_concurrent_files);
+		try:
+			futures = pool.invokeAll(jobs);
+			for job, future in zip(jobs, futures):
+				try:
+					future.get();
+				except (Exception, JavaException) as e:
+					print("Failed to process " + job.file_path + ": " + str(e));
+					failed.append(job.file_path);
+		finally:
+			pool.shutdown();
+		if cache is not None:
+			cache.evict();
+	print("Processed " + str(len(jobs) - len(failed)) + " of " + str(len(jobs)) + " files");
+	return failed;
+
+def main(data_root, output_root, manifest_path=None, n_concurrent_files=1, cache_gb=DEFAULT_CACHE_GB):
 	if (data_root is None) or (output_root is None):
-		raise IOError("File location dialogs cancelled!");
+		raise IOError("No input or output folder given!");
 	timestamp = datetime.strftime(datetime.now(), "%Y-%m-%d %H.%M.%S")
 	output_path = os.path.join(output_root,  (timestamp + " output"));
+	# intermediates are cached across runs (cache_gb=0 to disable)
+	cache = None;
+	if cache_gb > 0:
+		cache = StageCache(os.path.join(output_root, CACHE_FOLDER_NAME), int(cache_gb * 1024 ** 3));
+
+	# with a manifest, given or alongside the data, run without any UI
+	if manifest_path is None:
+		manifest_path = find_manifest(data_root);
+	if manifest_path is not None:
+		run_headless(data_root, output_path, manifest_path, n_concurrent_files=n_concurrent_files, cache=cache);
+		return;
+	if GraphicsEnvironment.isHeadless():
+		raise IOError("Running headless, but no manifest (" + " or ".join(MANIFEST_NAMES) + ") found in " + data_root);
+
 	for file_path in filterByFileType(os.listdir(data_root), '.tif'):
 		subfolder_name = os.path.splitext(file_path)[0];
 		output_subfolder = os.path.join(output_path, subfolder_name);
@@ -139,87 +809,15 @@ def main():
 		imps = bf.openImagePlus(os.path.join(data_root, file_path));
 		imp = imps[0];
 		imp.show();
-		h = imp.height;
-		w = imp.width;
-		slices = imp.getNSlices();
-		channels = imp.getNChannels();
-		frames = imp.getNFrames();
-		
-		# rotation step - since using multiples of 90, TransformJ.Turn is more efficient
-		IJ.run("Enhance Contrast", "saturated=0.35");
-		angleZ = 1;
-		while ((angleZ % 90) > 0):
-			gd = GenericDialog("Rotate?");
-			gd.addMessage("Define rotation angle - increments of 90. Apical at top");
-			gd.addNumericField("Rotation angle", 0, 0);
-			gd.showDialog();
-			angleZ = int(gd.getNextNumber());
-			
-		if (angleZ > 1):
-			IJ.run("TransformJ Turn",  "z-angle=" + str(angleZ) + " y-angle=0 x-angle=0");
-			imp.close();
-			imp = WindowManager.getCurrentImage();
-			imp.setTitle(file_path);
-
-		# trim time series
-		IJ.run("Enhance Contrast", "saturated=0.35");
-		imp.setDisplayMode(IJ.COLOR);
-		WaitForUserDialog("Scroll to the first frame of the period of interest and click OK").show();
-		start_frame = imp.getT();
-		WaitForUserDialog("Scroll to the last frame of the period of interest and click OK").show();
-		end_frame = imp.getT();
-		trim_imp = Duplicator().run(imp, 1, channels, 1, slices, start_frame, end_frame);
-		imp.close();
-		trim_imp.show();
-		dup_imp = Duplicator().run(trim_imp);
-
-		# create images to process and find bounds for
-		dup_imps = ChannelSplitter().split(dup_imp);
-		myo_imp = dup_imps[1];
-		mem_imp = dup_imps[0];
-		FileSaver(myo_imp).saveAsTiffStack(os.path.join(output_subfolder, "myosin_channel.tif"));
-		FileSaver(mem_imp).saveAsTiffStack(os.path.join(output_subfolder, "membrane_channel.tif"));
-
-		# set basal bounds
-		myo_imp.show();
-		ImageConverter(myo_imp).convertToGray8();
-		frames = myo_imp.getNFrames();	
-		gb = GaussianBlur();
-		for fridx in range(0, frames):
-			myo_imp.setSliceWithoutUpdate(fridx + 1);
-			ip = myo_imp.getProcessor();
-			gb.blurGaussian(ip, 5.0, 1.0, 0.02); # assymmetrical Gaussian
-		IJ.run(myo_imp, "Convert to Mask", "method=Otsu background=Dark calculate");
-		IJ.run("Despeckle", "stack");
-		title = myo_imp.getTitle();
-
-		# assume that first frame is good quality image...
-		basal_edges = find_basal_edges(myo_imp);
-		#myo_imp.hide()
-		mem_imp.hide();
-
-		# draw some edges for checking
-		roim = RoiManager();
-		xs = [x for x in range(1, trim_imp.getWidth()+1)];
-		trim_imp.show();
-		for fridx in range(0, myo_imp.getNFrames()):
-			trim_imp.setPosition(2, 1, fridx+1);
-			IJ.run("Enhance Contrast", "saturated=0.35");
-					
-			roi = PolygonRoi(xs, basal_edges[fridx], Roi.POLYLINE);
-			trim_imp.setRoi(roi);
-			roim.addRoi(roi);
-		#myo_imp.show()
-
-		# after getting rid of incorrectly segmented non-basal myosin, 
-		# perform previous edge search to identify the bottom AND TOP edges of the bright band
-		# then can draw these on the masks, fill holes and have a mask that effectively collects
-		# all basal myosin, as well as a line that delineates the end of the cell
-		
-		
-	
+		imp, params = ask_file_parameters(imp);
+		params["file"] = file_path;
+		process_file(imp, output_subfolder, params, cache=cache, 
+						input_hash=None if cache is None else cache.file_hash(os.path.join(data_root, file_path)));
+		if cache is not None:
+			cache.evict();
 
 # It's best practice to create a function that contains the code that is executed when running the script.
 # This enables us to stop the script by just calling return.
 if __name__ in ['__builtin__','__main__']:
-    main()
\ No newline at end of file
+    main(data_root.getPath(), output_root.getPath(), manifest_path=None if manifest is None else manifest.getPath(), 
+         n_concurrent_files=n_concurrent_files, cache_gb=cache_gb)
\ No newline at end of file
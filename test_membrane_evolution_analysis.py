@@ -0,0 +1,50 @@
+# Checks of membrane_evolution_analysis.py that need ImageJ: run this file from Fiji's script editor with 
+# this folder on the Jython path. Under CPython (pytest) it is skipped.
+try:
+	from ij.gui import PolygonRoi, Roi
+	from ij.process import FloatPolygon
+except ImportError:
+	import pytest
+	pytest.skip("needs ImageJ - run from Fiji", allow_module_level=True)
+
+import os, shutil, tempfile
+from array import array
+import membrane_evolution_analysis as mea
+
+def make_membrane(roi_type):
+	xs = [10.5, 20.25, 30.0, 41.75];
+	ys = [5.0, 7.5, 6.25, 12.0];
+	return mea.DrawnMembrane(PolygonRoi(FloatPolygon(xs, ys), roi_type), positionNumber=1);
+
+def test_moving_roi_leaves_membrane_unchanged():
+	for roi_type in [Roi.FREELINE, Roi.POLYLINE]:
+		membrane = make_membrane(roi_type);
+		xs = array('f', membrane.xpoints);
+		ys = array('f', membrane.ypoints);
+		roi = membrane.getRoi();
+		roi.setLocation(100.0, 200.0);
+		assert membrane.xpoints == xs and membrane.ypoints == ys;
+		assert membrane.matchesRoi(membrane.getRoi());
+		assert not membrane.matchesRoi(roi);
+
+def test_finished_journal_is_not_resumed():
+	output_root = tempfile.mkdtemp();
+	try:
+		journal_path = os.path.join(output_root, "Membranes 2020-01-02 03-04-05" + mea.JOURNAL_EXTENSION);
+		journal = mea.MembraneJournal(journal_path, [mea.TimepointsMembranes(input_image_title="embryo", time_point_s=t) 
+													for t in [0, 10]]);
+		journal.recordMembrane(1, make_membrane(Roi.FREELINE));
+		journal.close();
+		assert mea.find_resumable_journal(output_root, "embryo") == journal_path;
+		assert mea.journal_timestamp(journal_path) == "2020-01-02 03-04-05";
+		json_path = mea.finish_journal(journal_path);
+		assert os.path.splitext(json_path)[0] == os.path.splitext(journal_path)[0];
+		assert mea.find_resumable_journal(output_root, "embryo") is None;
+	finally:
+		shutil.rmtree(output_root);
+
+if __name__ in ['__builtin__','__main__']:
+	for name, test in sorted(globals().items()):
+		if name.startswith("test_"):
+			test();
+			print(name + " passed");
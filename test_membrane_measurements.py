@@ -0,0 +1,37 @@
+# Checks membrane_measurements.py against measurements made in ImageJ. test_data/membrane_measurements
+# holds the outputs of a drawing session - Membranes JSON, settings and the "Membrane measurements" CSV
+# from DrawnMembrane.measure() in ImageJ 1.51g - with freehand, segmented and straight line membranes
+# at 0.1833 micron/pixel
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import membrane_file as mf
+import membrane_measurements as mm
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'membrane_measurements')
+SESSION = '2026-10-18 12.00.00'
+PIXEL_SIZE = 0.1833
+
+def check_table(table):
+	expected = pd.read_csv(os.path.join(DATA_FOLDER, mm.MEASUREMENTS_PREFIX + SESSION + '.csv'))
+	assert list(table.columns) == list(expected.columns)
+	np.testing.assert_array_equal(table.iloc[:, :2].values, expected.iloc[:, :2].values)
+	np.testing.assert_allclose(table.iloc[:, 2:].values, expected.iloc[:, 2:].values, rtol=1e-5, atol=1e-6)
+
+def test_reproduces_session_measurements():
+	json_path = os.path.join(DATA_FOLDER, mm.MEMBRANES_PREFIX + SESSION + '.json')
+	check_table(mm.measurements_table(json_path, pixel_size=PIXEL_SIZE, unit='micron'))
+
+def test_binary_container_gives_session_measurements(tmp_path):
+	json_path = os.path.join(DATA_FOLDER, mm.MEMBRANES_PREFIX + SESSION + '.json')
+	binary_path = mf.convert_json(json_path, binary_path=str(tmp_path / (mm.MEMBRANES_PREFIX + SESSION + '.mbin')))
+	check_table(mm.measurements_table(binary_path, pixel_size=PIXEL_SIZE, unit='micron',
+									  membrane_indices=mm.read_membrane_indices(DATA_FOLDER)))
+
+def test_only_freehand_membranes_are_smoothed():
+	zigzag = np.array([[0, 0], [3, 2], [6, 0], [9, 2], [12, 0], [15, 2]], dtype=float)
+	freeline, polyline = mm.measure_paths([zigzag, zigzag], roi_types=[mm.FREELINE, mm.POLYLINE])['path length']
+	assert freeline < polyline
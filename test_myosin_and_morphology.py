@@ -0,0 +1,60 @@
+# Checks of myosin_and_morphology.py that need ImageJ: run this file from Fiji's script editor with
+# this folder on the Jython path. Under CPython (pytest) it is skipped.
+try:
+	from ij import IJ, ImagePlus, ImageStack, Prefs
+	from ij.process import ByteProcessor
+	from ij.plugin.filter import GaussianBlur
+except ImportError:
+	import pytest
+	pytest.skip("needs ImageJ - run from Fiji", allow_module_level=True)
+
+import math
+from java.util import Random
+import myosin_and_morphology as mam
+
+def make_stack(n_frames=4, width=96, height=64):
+	"""noisy 8-bit frames with a bright band moving down, the same for every call"""
+	random = Random(1);
+	stack = ImageStack(width, height);
+	for fridx in range(0, n_frames):
+		ip = ByteProcessor(width, height);
+		for y in range(0, height):
+			for x in range(0, width):
+				value = (40 + (60 + 10 * fridx) * math.exp(-(y - 20 - 3 * fridx) ** 2 / 30.0) +
+							30 * math.sin(x / 7.0) + (15 + 5 * fridx) * random.nextGaussian());
+				ip.set(x, y, int(max(0, min(255, value))));
+		stack.addSlice(ip);
+	return ImagePlus("myosin", stack);
+
+def convert_to_mask_pipeline(imp):
+	"""the preprocessing as it was before preprocess_frame, with IJ.run for thresholding and despeckling"""
+	gb = GaussianBlur();
+	params = mam.PREPROCESSING_PARAMETERS;
+	for fridx in range(0, imp.getStackSize()):
+		gb.blurGaussian(imp.getStack().getProcessor(fridx + 1), params["blur_sigma_x"], params["blur_sigma_y"],
+						params["blur_accuracy"]);
+	IJ.run(imp, "Convert to Mask", "method=Otsu background=Dark calculate");
+	IJ.run(imp, "Despeckle", "stack");
+	return imp;
+
+def test_preprocess_matches_convert_to_mask():
+	black_background = Prefs.blackBackground;
+	try:
+		for black in [True, False]:
+			Prefs.blackBackground = black;
+			expected = convert_to_mask_pipeline(make_stack());
+			for n_threads in [1, 3]:
+				actual = make_stack();
+				mam.preprocess_stack(actual, n_threads=n_threads);
+				assert actual.isInvertedLut() == expected.isInvertedLut();
+				for fridx in range(0, actual.getStackSize()):
+					assert (list(actual.getStack().getPixels(fridx + 1)) ==
+							list(expected.getStack().getPixels(fridx + 1))), "frame " + str(fridx + 1);
+	finally:
+		Prefs.blackBackground = black_background;
+
+if __name__ in ['__builtin__','__main__']:
+	for name, test in sorted(globals().items()):
+		if name.startswith("test_"):
+			test();
+			print(name + " passed");
@@ -31,31 +31,29 @@ def find_basal_edges(imp, search_range=10):
 		print("Examining frame " + str(fridx) + "...");
 		imp.setPosition(1, 1, fridx+1);
 		#imp.setSliceWithoutUpdate(fridx + 1)
+		# scan the frame's pixel array directly rather than calling imp.getPixel for every pixel - 
+		# see find_basal_edges_bulk in myosin_and_morphology.py
+		w = imp.getWidth();
+		h = imp.getHeight();
+		pix = imp.getStack().getPixels(imp.getStackIndex(1, 1, fridx+1));
 		if (fridx == 0):
-			edge = imp.getWidth() * [-1];
-			for xidx in range(0, imp.getWidth()):
-				yidx = imp.getHeight() - 1;
-				pix_val = imp.getPixel(xidx, yidx)[0];
-				while (pix_val == 0):
+			edge = w * [-1];
+			for xidx in range(0, w):
+				yidx = h - 1;
+				while (yidx >= 0) and (pix[yidx * w + xidx] == 0):
 					yidx = yidx - 1;
-					pix_val = imp.getPixel(xidx, yidx)[0];
 				edge[xidx] = yidx;
 		else:
 			# confine search for edge to region of search_range (10 pix default) either side
 			# of the last frame's edge. If no edge is found in that region, must be a hole in 
 			# the binary image. Assign a dummy value and deal with it in second loop. 
-			edge = imp.getWidth() * [-1];
-			for xidx in range(0, imp.getWidth()):
+			edge = w * [-1];
+			for xidx in range(0, w):
 				yidx = int(edges[fridx-1][xidx] + search_range);
-				try:
-					pix_val = imp.getPixel(xidx, yidx)[0];
-				except TypeError:
-					print(xidx);
-					print(yidx);
-					raise TypeError;
+				pix_val = pix[yidx * w + xidx] if (0 <= yidx < h) else 0;
 				while (pix_val==0) and (yidx > (edges[fridx-1][xidx] - search_range)):
 					yidx = yidx - 1;
-					pix_val = imp.getPixel(xidx, yidx)[0];
+					pix_val = pix[yidx * w + xidx] if (0 <= yidx < h) else 0;
 				if (pix_val != 0):
 					edge[xidx] = yidx;
 			